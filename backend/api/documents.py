@@ -1,14 +1,20 @@
+import os
 import traceback
+import zipfile
 from datetime import datetime
 from typing import List, Optional
 from fastapi import APIRouter, File, UploadFile, HTTPException, Depends, Body
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from service.document_service import DocumentService
 from db.database import get_db
 from pydantic import BaseModel
 from utils.logger import logger
 from service.redis_service import redis_service
+from service.milvus_service import milvus_service
+from service.ingestion_service import ingestion_service
+from service.config import Config
 
 
 router = APIRouter()
@@ -26,6 +32,7 @@ class DocumentResponse(DocumentBase):
     id: str
     file_type: str  # 添加文件类型字段
     file_status: int
+    version: int = 1
     file_name: str
     upload_time: datetime
     file_size: int
@@ -38,30 +45,140 @@ class DocumentList(BaseModel):
     documents: List[DocumentResponse] 
 
 
-@router.post("/upload", response_model=DocumentResponse)
-async def upload_document(file: UploadFile = File(...), chunk_size: int = 150, overlap_size: int = 20, embedding_model: str = 'BGE M3', db: Session = Depends(get_db)):
+class IngestionFileStatus(BaseModel):
+    """批量入库任务中单个文件的状态"""
+    file_name: str
+    document_id: str
+    status: str
+    error: Optional[str] = None
+
+
+class IngestionJobResponse(BaseModel):
+    """入库任务响应模型"""
+    job_id: str
+    document_id: Optional[str] = None
+    file_name: str
+    status: str
+    error: Optional[str] = None
+    attempts: int
+    chunks_total: int
+    chunks_embedded: int
+    chunks_inserted: int
+    chunks_unchanged: int = 0
+    created_at: datetime
+    updated_at: datetime
+    files: Optional[List[IngestionFileStatus]] = None
+    summary: Optional[dict] = None
+
+
+class IngestionJobList(BaseModel):
+    """入库任务列表响应模型"""
+    jobs: List[IngestionJobResponse]
+
+
+@router.post("/upload", response_model=IngestionJobResponse)
+async def upload_document(file: UploadFile = File(...), chunk_size: int = Config.CHUNK_TOKEN_SIZE, overlap_size: int = Config.CHUNK_TOKEN_OVERLAP, embedding_model: str = 'BGE M3', document_id: Optional[str] = None, db: Session = Depends(get_db)):
     # 检查文件类型是否允许
     document_service = DocumentService(db)
     if not document_service.allowed_file(file.filename):
         raise HTTPException(status_code=400, detail="不支持的文件类型")
-    
-     # 处理文档
-    document = document_service.process_document(file, chunk_size, overlap_size, embedding_model)
 
-    if document is None:
+    # 指定文档ID或已有同名文档时，作为该文档的新版本按切片比对更新
+    if document_id is not None:
+        target = document_service.get_document(document_id)
+        if target is None:
+            raise HTTPException(status_code=404, detail="文档不存在")
+    else:
+        target = document_service.find_document_by_name(file.filename)
+    if target is not None and ingestion_service.has_active_document(target.id):
+        raise HTTPException(status_code=409, detail="该文档正在更新中")
+    
+    # 流式落盘并计算哈希，在解析之前完成去重
+    document_uuid, file_path, file_hash, file_size = await run_in_threadpool(document_service.save_upload, file)
+    if ingestion_service.has_active_hash(file_hash):
+        os.remove(file_path)
+        raise HTTPException(status_code=200, detail="文件已存在")
+    if document_service.is_duplicate_upload(file_path, file.filename, file_hash):
         raise HTTPException(status_code=200, detail="文件已存在")
+
+    # 提交后台入库任务，立即返回任务信息
+    job = ingestion_service.submit(
+        file.filename, file_path, document_uuid, chunk_size, overlap_size, embedding_model, file_hash, file_size,
+        replace_document_id=target.id if target is not None else None
+    )
     
     del document_service
-        
-    # 返回文档信息
-    return {
-        "id": str(document.id),
-        "file_name": document.file_name,
-        "upload_time": document.upload_time,
-        "file_size": document.file_size,
-        "file_status": document.status,
-        "file_type": document.file_type
-    }
+    return job.to_dict()
+
+
+@router.post("/upload/bulk", response_model=IngestionJobResponse)
+async def upload_documents_bulk(files: List[UploadFile] = File(...), chunk_size: int = Config.CHUNK_TOKEN_SIZE, overlap_size: int = Config.CHUNK_TOKEN_OVERLAP, embedding_model: str = 'BGE M3', db: Session = Depends(get_db)):
+    # 支持多个文件及zip压缩包，压缩包内不支持的文件类型直接跳过
+    document_service = DocumentService(db)
+    saved_files = []
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                saved_files.extend(await run_in_threadpool(document_service.save_archive, file))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f"无效的压缩包: {file.filename}")
+        elif document_service.allowed_file(file.filename):
+            saved_files.append(await run_in_threadpool(document_service.save_stream, file.file, file.filename))
+    if not saved_files:
+        raise HTTPException(status_code=400, detail="没有支持的文件类型")
+
+    # 解析、去重与入库均在后台任务中完成
+    job = ingestion_service.submit_bulk(saved_files, chunk_size, overlap_size, embedding_model)
+
+    del document_service
+    return job.to_dict()
+
+
+@router.post("/sync", response_model=IngestionJobResponse)
+async def sync_directory(directory: str = Body(...), chunk_size: int = Body(Config.CHUNK_TOKEN_SIZE), overlap_size: int = Body(Config.CHUNK_TOKEN_OVERLAP), embedding_model: str = Body('BGE M3')):
+    # 仅允许同步配置中的目录及其子目录
+    directory = os.path.abspath(directory)
+    if not any(os.path.commonpath([os.path.abspath(allowed), directory]) == os.path.abspath(allowed) for allowed in Config.SYNC_ALLOWED_DIRS):
+        raise HTTPException(status_code=403, detail="该目录不允许同步")
+    if not os.path.isdir(directory):
+        raise HTTPException(status_code=400, detail="目录不存在")
+    try:
+        job = ingestion_service.submit_sync(directory, chunk_size, overlap_size, embedding_model)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return job.to_dict()
+
+
+@router.get("/jobs", response_model=IngestionJobList)
+async def list_ingestion_jobs():
+    return {"jobs": [job.to_dict() for job in ingestion_service.list_jobs()]}
+
+
+@router.get("/jobs/{job_id}", response_model=IngestionJobResponse)
+async def get_ingestion_job(job_id: str):
+    job = ingestion_service.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=IngestionJobResponse)
+async def cancel_ingestion_job(job_id: str):
+    job = ingestion_service.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+
+@router.post("/jobs/{job_id}/retry", response_model=IngestionJobResponse)
+async def retry_ingestion_job(job_id: str):
+    try:
+        job = ingestion_service.retry(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
 
 
 @router.get("/list", response_model=DocumentList)
@@ -80,7 +197,8 @@ async def list_documents(db: Session = Depends(get_db)):
                 "upload_time": doc.upload_time,
                 "file_size": doc.file_size,
                 "file_type": doc.file_type,
-                "file_status": doc.status
+                "file_status": doc.status,
+                "version": doc.version
             })
         del document_service
         return {"documents": documents}
@@ -90,6 +208,11 @@ async def list_documents(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"获取文档列表失败: {str(e)}")
 
 
+@router.get("/collection/status")
+async def collection_status():
+    return milvus_service.collection_manager.get_load_status(Config.MILVUS_COLLECTION_NAME)
+
+
 @router.delete("/{doc_id}")
 async def delete_document(doc_id: str, db: Session = Depends(get_db)):
     try:
@@ -1,10 +1,15 @@
+import json
 from typing import Dict, Any, Optional
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, ConfigDict
 from sqlalchemy.orm import Session
 
-from service.rag_service import RAGService
+from service.rag_service import RAGService, request_coalescer
 from service.conversation_service import ConversationService
+from service.milvus_service import milvus_service
+from service.llm_cache import llm_response_cache
+from service.answer_cache import answer_cache
 from db.database import get_db
 from service.config import Config
 from utils.logger import logger
@@ -44,6 +49,39 @@ class RAGChatResponse(BaseModel):
     message_id: str = Field(..., description="消息ID")
 
 
+def prepare_conversation(conversation_service: ConversationService, request: RAGChatRequest) -> str:
+    '''
+    获取或创建对话并写入用户消息，返回对话ID
+    '''
+    conversation_id = request.conversation_id
+    conversation = None
+    
+    if conversation_id:
+        # 尝试获取现有对话
+        conversation = conversation_service.get_conversation(conversation_id)
+        logger.info(f"获取现有对话: {conversation_id}")
+        
+    if not conversation:
+        # 创建新对话
+        title = request.query[:50] + "..." if len(request.query) > 50 else request.query
+        conversation = conversation_service.create_conversation(title=title)
+        conversation_id = str(conversation.id)
+        logger.info(f"创建新对话: {conversation_id}")
+    
+    # 添加用户消息
+    conversation_service.add_message(
+        conversation_id=conversation_id,
+        role="user",
+        content=request.query
+    )
+    logger.info(f"添加用户消息, content: {request.query}")
+    return conversation_id
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @router.post("/chat", response_model=RAGChatResponse)
 async def rag_chat(request: RAGChatRequest, db: Session = Depends(get_db)):
     rag_service = RAGService(db)
@@ -51,28 +89,7 @@ async def rag_chat(request: RAGChatRequest, db: Session = Depends(get_db)):
         # 创建对话服务
         conversation_service = ConversationService(db)
         # 获取或创建对话
-        conversation_id = request.conversation_id
-        conversation = None
-        
-        if conversation_id:
-            # 尝试获取现有对话
-            conversation = conversation_service.get_conversation(conversation_id)
-            logger.info(f"获取现有对话: {conversation_id}")
-            
-        if not conversation:
-            # 创建新对话
-            title = request.query[:50] + "..." if len(request.query) > 50 else request.query
-            conversation = conversation_service.create_conversation(title=title)
-            conversation_id = str(conversation.id)
-            logger.info(f"创建新对话: {conversation_id}")
-        
-        # 添加用户消息
-        conversation_service.add_message(
-            conversation_id=conversation_id,
-            role="user",
-            content=request.query
-        )
-        logger.info(f"添加用户消息, content: {request.query}")
+        conversation_id = prepare_conversation(conversation_service, request)
         # RAG
         rag_response = await rag_service.non_streaming_workflow(
             conversation_id=conversation_id,
@@ -93,4 +110,57 @@ async def rag_chat(request: RAGChatRequest, db: Session = Depends(get_db)):
             message_id=str(ai_message.id)
         )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"RAG聊天失败: {str(e)}") 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"RAG聊天失败: {str(e)}") 
+
+
+@router.post("/chat/stream")
+async def rag_chat_stream(request: RAGChatRequest, db: Session = Depends(get_db)):
+    '''
+    流式RAG聊天，以Server-Sent Events返回：metadata（检索元数据）→ token（逐段回答）→ done（消息ID），出错时返回error
+    '''
+    rag_service = RAGService(db)
+    conversation_service = ConversationService(db)
+    try:
+        conversation_id = prepare_conversation(conversation_service, request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"RAG聊天失败: {str(e)}")
+
+    async def event_stream():
+        response_parts = []
+        try:
+            async for event in rag_service.streaming_workflow(conversation_id=conversation_id, user_query=request.query):
+                if event['event'] == 'metadata':
+                    event['data']['conversation_id'] = conversation_id
+                elif event['event'] == 'token':
+                    response_parts.append(event['data']['content'])
+                yield format_sse(event['event'], event['data'])
+
+            # 流结束后保存完整的模型消息
+            response = "".join(response_parts)
+            logger.info(f'LLM response: {response}')
+            ai_message = conversation_service.add_message(
+                conversation_id=conversation_id,
+                role="assistant",
+                content=response
+            )
+            yield format_sse('done', {'conversation_id': conversation_id, 'message_id': str(ai_message.id)})
+        except Exception as e:
+            logger.error(f"RAG流式聊天失败: {str(e)}")
+            yield format_sse('error', {'detail': f"RAG聊天失败: {str(e)}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/stats")
+async def rag_stats():
+    return {
+        "query_embedding_cache": milvus_service.embedding_model.query_cache.stats(),
+        "rerank_score_cache": milvus_service.rerank_cache.stats(),
+        "llm_cache": llm_response_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "request_coalescing": request_coalescer.stats(),
+    }
@@ -53,6 +53,19 @@ def init_database():
         print(f"数据库初始化失败: {str(e)}")
         return False
 
+def migrate_database():
+    """
+    执行表结构迁移脚本，为已有部署的表补充新增的列与索引；脚本可重复执行，服务及同步脚本启动时调用
+    """
+    from db.database import engine
+
+    sql_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', '02-migrate-documents.sql')
+    with open(sql_file_path, 'r', encoding='utf-8') as f:
+        sql_script = f.read()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(sql_script)
+
+
 if __name__ == "__main__":
     print("开始初始化数据库...")
     success = init_database()
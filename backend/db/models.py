@@ -58,6 +58,8 @@ class Document(Base):
     file_hash = Column(String(255), nullable=False)
     status = Column(Integer, nullable=False, default=1)
     upload_time = Column(DateTime(timezone=True), server_default=func.now())
+    source_path = Column(String(1024), nullable=True, index=True)  # 目录同步入库的源文件路径，上传的文档为空
+    version = Column(Integer, nullable=False, default=1)  # 文档版本号，重新上传新版本时递增
 
     def to_dict(self):
         return {
@@ -66,5 +68,6 @@ class Document(Base):
             "file_size": self.file_size,
             "file_type": self.file_type,
             "file_status": self.status,
+            "version": self.version,
             "upload_time": self.upload_time.isoformat() + "+08:00" if self.upload_time else None
         }
\ No newline at end of file
@@ -4,11 +4,15 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from service.config import Config
-from api import documents, rag, conversations
-from service.milvus_service import MilvusService
 
 
 def create_app():
+    # 在函数内导入服务模块，批量入库的spawn解析子进程重新导入本模块时不会加载模型
+    from api import documents, rag, conversations
+    from service.milvus_service import milvus_service
+    from service.llm_service import LLM_Service
+    from service.ingestion_service import ingestion_service
+    from db.init_db import migrate_database
 
     # 创建FastAPI应用
     app = FastAPI(title="CURSORCHAT")
@@ -27,9 +31,21 @@ def create_app():
     app.include_router(rag.router, prefix=f"{Config.API_PREFIX}{Config.API_V1_STR}/rag", tags=["rag"])
     app.include_router(conversations.router, prefix=f"{Config.API_PREFIX}{Config.API_V1_STR}/conversations", tags=["conversations"])
 
+    # 为已有部署的数据库补充新增的列与索引
+    app.add_event_handler("startup", migrate_database)
+    # 启动时加载一次集合，之后常驻内存
+    app.add_event_handler("startup", lambda: milvus_service.collection_manager.ensure_loaded(Config.MILVUS_COLLECTION_NAME))
+    # 关闭异步Milvus客户端及推理线程池
+    app.add_event_handler("shutdown", milvus_service.close)
+    # 关闭LLM共享连接池
+    app.add_event_handler("shutdown", LLM_Service.close)
+    # 停止后台入库线程池，执行中的任务在批次边界取消
+    app.add_event_handler("shutdown", ingestion_service.shutdown)
+
     return app
 
-app = create_app()
+if __name__ != "__mp_main__":
+    app = create_app()
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True) 
\ No newline at end of file
@@ -0,0 +1,4 @@
+-- 为已有部署的documents表补充新增的列与索引，可重复执行
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS source_path VARCHAR(1024);
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+CREATE INDEX IF NOT EXISTS idx_documents_source_path ON documents(source_path);
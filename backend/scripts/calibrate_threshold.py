@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+根据已标注样本校准重排序分数并拟合相关性阈值。
+样本文件为JSONL，每行格式：{"query": "...", "text": "...", "label": 1}
+用法（在backend目录下执行）：python scripts/calibrate_threshold.py samples.jsonl [--target-precision 0.9]
+"""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymilvus.model.reranker import BGERerankFunction
+from service.config import Config
+from utils.calibration import calibrate_score, fit_platt_scaling, fit_threshold
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("samples", help="标注样本文件路径（JSONL）")
+parser.add_argument("--target-precision", type=float, default=None, help="目标精确率，不指定则按F1选择阈值")
+args = parser.parse_args()
+
+with open(args.samples, "r", encoding="utf-8") as f:
+    samples = [json.loads(line) for line in f if line.strip()]
+print(f"读取标注样本 {len(samples)} 条")
+
+reranker = BGERerankFunction(model_name=Config.RERANKING_MODEL, device='cpu')
+scores = []
+for sample in samples:
+    result = reranker(sample["query"], [sample["text"]], top_k=1)
+    scores.append(result[0].score)
+labels = [int(sample["label"]) for sample in samples]
+
+a, b = fit_platt_scaling(scores, labels)
+calibrated_scores = [calibrate_score(score, a, b) for score in scores]
+best = fit_threshold(calibrated_scores, labels, target_precision=args.target_precision)
+if best is None:
+    print("没有满足目标精确率的阈值")
+    sys.exit(1)
+
+print(f"精确率: {best['precision']:.4f}, 召回率: {best['recall']:.4f}, F1: {best['f1']:.4f}")
+print("请将以下配置写入 service/config.py：")
+print(f"    SCORE_CALIBRATION_A = {a:.6f}")
+print(f"    SCORE_CALIBRATION_B = {b:.6f}")
+print(f"    THRESHOLD = {best['threshold']:.4f}")
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+将目录中的文档增量同步到知识库：只入库新增或内容变化的文件，删除已移除文件的文档，中断后重新执行即可续传。
+用法（在backend目录下执行）：python scripts/sync_directory.py /data/shared [--chunk-size 512] [--overlap-size 64]
+"""
+
+import os
+import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def report(file, status, error=None):
+    print(f"[{status}] {file['source_path']}" + (f" {error}" if error else ""))
+
+
+def main():
+    # 解析子进程以spawn方式启动并重新导入本脚本，服务模块只在主进程中导入
+    from db.database import SessionLocal
+    from db.init_db import migrate_database
+    from service.config import Config
+    from service.document_service import DocumentService
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="需要同步的目录")
+    parser.add_argument("--chunk-size", type=int, default=Config.CHUNK_TOKEN_SIZE, help="切片长度")
+    parser.add_argument("--overlap-size", type=int, default=Config.CHUNK_TOKEN_OVERLAP, help="切片重叠长度")
+    parser.add_argument("--embedding-model", default="BGE M3", help="嵌入模型")
+    args = parser.parse_args()
+
+    migrate_database()
+    db = SessionLocal()
+    try:
+        document_service = DocumentService(db)
+        files, summary = document_service.prepare_sync(args.directory)
+        print(f"共 {summary['total']} 个文件：新增 {summary['new']}，变化 {summary['changed']}，未变化 {summary['unchanged']}，"
+              f"跳过 {summary['skipped']}，删除 {summary['deleted']}")
+        if files:
+            with ProcessPoolExecutor(max_workers=Config.BULK_EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+                documents = document_service.ingest_bulk(
+                    files, args.chunk_size, args.overlap_size, args.embedding_model, pool, file_callback=report
+                )
+            print(f"入库完成 {len(documents)}/{len(files)} 个文件")
+        document_service.finish_sync(args.directory)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from typing import Optional
+
+import numpy as np
+
+from service.config import Config
+from utils.logger import logger
+
+
+class SemanticAnswerCache:
+    '''
+    首轮问题的语义答案缓存：以BGE-M3查询向量做最近邻查找，相似度达到阈值且知识库版本一致时直接返回缓存的答案与引用。
+    每个条目记录写入时的知识库版本号，版本变化后旧条目一律清除，保证不会返回过期答案。
+    向量存放在预分配的(max_entries, dimension)环形缓冲区中，每次写入只覆盖一行，满后覆盖最早写入的条目。
+    '''
+    def __init__(self, max_entries: int, threshold: float, dimension: int):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.dimension = dimension
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 缓冲区在首次写入时分配，_valid标记有效的行，_next为下一个写入位置
+        self._vectors = None
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._entries = [None] * max_entries
+        self._next = 0
+        self._corpus_version = None
+
+    def lookup(self, vector, corpus_version: int) -> Optional[dict]:
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version(corpus_version)
+            if not self._valid.any():
+                self.misses += 1
+                return None
+            similarities = np.where(self._valid, self._vectors @ vector, -np.inf)
+            best_index = int(np.argmax(similarities))
+            if similarities[best_index] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            logger.info(f"语义答案缓存命中，相似度 {similarities[best_index]:.4f}")
+            return dict(self._entries[best_index])
+
+    def put(self, vector, result: dict, corpus_version: int):
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version(corpus_version)
+            if corpus_version != self._corpus_version:
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, self.dimension), dtype=np.float32)
+            self._vectors[self._next] = vector
+            self._valid[self._next] = True
+            self._entries[self._next] = dict(result)
+            self._next = (self._next + 1) % self.max_entries
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": int(self._valid.sum()),
+            "corpus_version": self._corpus_version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _check_version(self, corpus_version: int):
+        # 调用方需持有self._lock；版本号只增不减，更新的版本到来时清空全部旧条目
+        if self._corpus_version is None or corpus_version > self._corpus_version:
+            if self._valid.any():
+                logger.info(f"知识库版本更新为 {corpus_version}，清空 {int(self._valid.sum())} 条语义答案缓存")
+            self._valid[:] = False
+            self._entries = [None] * self.max_entries
+            self._next = 0
+            self._corpus_version = corpus_version
+
+    def _normalize(self, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+answer_cache = SemanticAnswerCache(
+    max_entries=Config.ANSWER_CACHE_MAX_ENTRIES,
+    threshold=Config.ANSWER_CACHE_THRESHOLD,
+    dimension=Config.EMBEDDING_DIMENSION
+)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, asynccontextmanager
+
+from pymilvus import MilvusClient
+from utils.logger import logger
+
+
+class CollectionManager:
+    '''
+    管理Milvus集合的加载生命周期：启动时加载一次并常驻内存，检索热路径只做内存状态判断，不再触发load/release。
+    显式释放采用引用计数，仍有请求在使用集合时，释放会延迟到引用计数归零后执行。
+    load/release请求在_load_lock下串行执行，_lock只保护内存中的引用计数与状态，不会在持有期间访问Milvus，
+    因此在事件循环上更新引用计数不会被加载或释放阻塞。
+    '''
+    def __init__(self, client: MilvusClient):
+        self.client = client
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded = set()
+        self._ref_counts = defaultdict(int)
+        self._release_pending = set()
+
+    def is_loaded(self, collection_name: str) -> bool:
+        return collection_name in self._loaded
+
+    def ensure_loaded(self, collection_name: str) -> bool:
+        # 热路径：已加载则直接返回，不访问Milvus
+        if collection_name in self._loaded:
+            return True
+        with self._load_lock:
+            if collection_name in self._loaded:
+                return True
+            if not self.client.has_collection(collection_name=collection_name):
+                logger.warning(f"集合 {collection_name} 不存在，跳过加载")
+                return False
+            self.client.load_collection(collection_name=collection_name)
+            with self._lock:
+                self._loaded.add(collection_name)
+                self._release_pending.discard(collection_name)
+            logger.info(f"集合 {collection_name} 已加载到内存")
+            return True
+
+    def mark_unloaded(self, collection_name: str):
+        '''
+        Milvus侧状态与本地不一致时（如Milvus重启）调用，下一次请求会重新加载
+        '''
+        with self._lock:
+            self._loaded.discard(collection_name)
+
+    @contextmanager
+    def acquire(self, collection_name: str):
+        # 先登记引用再检查加载状态：并发的释放要么看到引用而推迟，要么先移出已加载集合使本请求重新加载
+        self._incr(collection_name)
+        try:
+            self.ensure_loaded(collection_name)
+            yield
+        finally:
+            if self._decr(collection_name):
+                self._release(collection_name)
+
+    @asynccontextmanager
+    async def async_acquire(self, collection_name: str):
+        self._incr(collection_name)
+        try:
+            if collection_name not in self._loaded:
+                await asyncio.to_thread(self.ensure_loaded, collection_name)
+            yield
+        finally:
+            if self._decr(collection_name):
+                await asyncio.to_thread(self._release, collection_name)
+
+    def release(self, collection_name: str, force: bool = False) -> bool:
+        '''
+        显式释放集合。仍有请求在使用时标记为待释放，返回False；force为True时立即释放。
+        '''
+        with self._lock:
+            self._release_pending.add(collection_name)
+            if self._ref_counts[collection_name] > 0 and not force:
+                logger.info(f"集合 {collection_name} 正在使用中，待引用计数归零后释放")
+                return False
+        return self._release(collection_name, force)
+
+    def get_load_status(self, collection_name: str) -> dict:
+        try:
+            milvus_state = str(self.client.get_load_state(collection_name=collection_name).get("state"))
+        except Exception as e:
+            logger.warning(f"获取集合 {collection_name} 加载状态失败: {e}")
+            milvus_state = None
+        return {
+            "collection_name": collection_name,
+            "loaded": collection_name in self._loaded,
+            "milvus_state": milvus_state,
+            "in_use": self._ref_counts[collection_name],
+            "release_pending": collection_name in self._release_pending,
+        }
+
+    def _incr(self, collection_name: str):
+        with self._lock:
+            self._ref_counts[collection_name] += 1
+
+    def _decr(self, collection_name: str) -> bool:
+        # 返回是否需要执行待释放操作，释放请求由调用方在锁外发起
+        with self._lock:
+            self._ref_counts[collection_name] -= 1
+            return self._ref_counts[collection_name] == 0 and collection_name in self._release_pending
+
+    def _release(self, collection_name: str, force: bool = False) -> bool:
+        with self._load_lock:
+            with self._lock:
+                # 等待_load_lock期间释放可能已由其他线程完成，或又有新的请求开始使用集合
+                if collection_name not in self._release_pending:
+                    return False
+                if self._ref_counts[collection_name] > 0 and not force:
+                    return False
+                self._loaded.discard(collection_name)
+                self._release_pending.discard(collection_name)
+            self.client.release_collection(collection_name=collection_name)
+            logger.info(f"集合 {collection_name} 已从内存释放")
+            return True
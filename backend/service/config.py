@@ -19,11 +19,24 @@ class Config:
     API_V1_STR = "/v1"
 
     # 允许上传的文件类型
-    ALLOWED_EXTENSIONS = {"pdf", "txt", "docx", "doc", "markdown"}
+    ALLOWED_EXTENSIONS = {"pdf", "txt", "docx", "doc", "md", "markdown"}
 
     # LLM相关配置
     LLM_BASE_URL = "https://api.siliconflow.cn/v1/chat/completions"                         # 接入LLM服务的基础URL                                          # 接入LLM服务的API_KEY，若无需验证可随便传
     LLM_MODEL = "Qwen/Qwen2.5-7B-Instruct"                                             # 接入LLM服务的模型选择，若无需验证可随便传
+    LLM_CONNECT_TIMEOUT = 5                                                            # LLM请求建立连接的超时时间（秒）
+    LLM_READ_TIMEOUT = 120                                                             # LLM请求读取响应的超时时间（秒）
+    LLM_MAX_CONNECTIONS = 100                                                          # LLM连接池最大连接数
+    LLM_KEEPALIVE_EXPIRY = 60                                                          # LLM空闲长连接保活时间（秒）
+    LLM_MAX_CONCURRENCY = 64                                                           # 全局在途LLM请求上限
+    LLM_MAX_CONCURRENCY_PER_REQUEST = 8                                                # 单次对话内在途LLM请求上限
+    LLM_CACHE_REWRITE_ENABLED = True                                                   # 是否缓存问题重写扩展的LLM结果
+    LLM_CACHE_JUDGE_ENABLED = True                                                     # 是否缓存相关性判断的LLM结果
+    LLM_CACHE_MAX_ENTRIES = 50000                                                      # LLM结果本地缓存的最大条目数
+    LLM_CACHE_MAX_MB = 64                                                              # LLM结果本地缓存的最大内存（MB）
+    LLM_CACHE_TTL = 24 * 3600                                                          # LLM结果缓存过期时间（秒）
+    LLM_CACHE_REDIS_ENABLED = False                                                    # 是否启用Redis作为LLM结果的共享二级缓存
+    LLM_CACHE_REDIS_PREFIX = "llm_cache"                                               # Redis LLM结果缓存键前缀
 
     # 本服务的授权验证
     API_KEY = os.getenv("API_KEY")    # 本服务允许使用的API_KEY列表
@@ -41,18 +54,68 @@ class Config:
     # 知识库检索及模型
     QUESTION_REWRITE_ENABLED = True                                       # 是否开启重写重写扩展
     QUESTION_REWRITE_NUM = 3                                              # 问题重写扩展数量（额外扩展的问题数量，不含原问题）
-    QUESTION_RETRIEVE_ENABLED = False                                      # 是否开启问题相关性判断
+    QUESTION_REWRITE_DEADLINE = 3                                         # 重写扩展的截止时间（秒），超时后使用已生成的重写问题继续
+    QUESTION_RETRIEVE_ENABLED = False                                      # 是否开启问题相关性判断（本地路由，闲聊问题跳过检索）
+    ROUTER_CORPUS_THRESHOLD = 0.5                                         # 与知识库质心相似度达到该值时一定检索
+    ROUTER_MARGIN = 0.1                                                   # 闲聊相似度高出知识库相似度该值时跳过检索
+    ROUTER_CENTROIDS = 16                                                 # 知识库质心数量
+    ROUTER_SAMPLE_SIZE = 10000                                            # 计算质心时采样的切片数量
+    ROUTER_HEAD_PATH = None                                               # 可选的线性分类头路径（npz，含weight与bias），配置后替代质心判断
     EMBEDDING_MODEL = './model_weight/bge-m3'                            # 嵌入模型的路径
+    EMBEDDING_DIMENSION = 1024                                            # 嵌入模型的向量维度
+    EMBEDDING_STORE_ENABLED = True                                        # 是否启用切片向量持久化存储
+    EMBEDDING_STORE_DIR = os.path.join(BASE_DIR, "backend/embedding_store")  # 切片向量持久化存储路径
     RETRIEVE_TOPK = 5                                                     # 每个问题检索的文档数量
     RERANKING_MODEL = './model_weight/bge-reranker-v2-m3'                # 重排序模型的路径
     USE_RERANKER = True                                                   # 是否使用重排序模型进行结果优化，建议将其开启
+    RERANK_CACHE_MAX_ENTRIES = 200000                                     # 重排序分数缓存的最大条目数
+    RERANK_CACHE_MAX_MB = 64                                              # 重排序分数缓存的最大内存（MB）
+    INFERENCE_WORKERS = 4                                                 # 嵌入/重排序模型推理线程池大小
+    EMBEDDING_BATCH_SIZE = 32                                             # 查询向量化微批的最大批大小
+    EMBEDDING_BATCH_WAIT_MS = 5                                           # 查询向量化微批的最长等待时间（毫秒）
+    EMBEDDING_CACHE_MAX_ENTRIES = 10000                                   # 查询向量本地缓存的最大条目数
+    EMBEDDING_CACHE_MAX_MB = 64                                           # 查询向量本地缓存的最大内存（MB）
+    EMBEDDING_CACHE_REDIS_ENABLED = False                                 # 是否启用Redis作为查询向量的共享二级缓存
+    EMBEDDING_CACHE_REDIS_TTL = 7 * 24 * 3600                             # Redis查询向量缓存过期时间（秒）
+    EMBEDDING_CACHE_REDIS_PREFIX = "query_embedding"                      # Redis查询向量缓存键前缀
 
     # 相关性判断策略
-    STRATEGY = 'llm'                                                      # 相关性判断策略，可选'llm'或'thres'，选择'llm'的判断更精准一些
-    THRESHOLD = 0.85   
+    STRATEGY = 'llm'                                                      # 相关性判断策略，可选'llm'、'thres'或'hybrid'，选择'llm'的判断更精准一些，'hybrid'仅对阈值附近的切片调用LLM
+    THRESHOLD = 0.85                                                      # 校准后重排序分数的相关性阈值，可由scripts/calibrate_threshold.py拟合
+    THRESHOLD_UNCERTAINTY_BAND = 0.1                                      # 'hybrid'策略下阈值上下的不确定区间宽度
+    SCORE_CALIBRATION_A = 1.0                                             # 重排序分数Platt缩放参数a
+    SCORE_CALIBRATION_B = 0.0                                             # 重排序分数Platt缩放参数b
+    JUDGE_BATCH_ENABLED = True                                            # 是否在一次LLM请求中批量判断所有切片的相关性
+    JUDGE_CHUNK_MAX_LENGTH = 300                                          # 批量判断时每个切片截断的最大长度
+
+    # 语义答案缓存
+    ANSWER_CACHE_ENABLED = True                                           # 是否开启首轮问题的语义答案缓存
+    ANSWER_CACHE_THRESHOLD = 0.95                                         # 命中缓存所需的查询向量余弦相似度
+    ANSWER_CACHE_MAX_ENTRIES = 5000                                       # 语义答案缓存的最大条目数
+    REQUEST_COALESCING_ENABLED = True                                     # 是否合并并发的相同首轮问题请求
+
+    # 文档入库
+    INGESTION_WORKERS = 1                                                 # 后台入库任务的工作线程数，与查询推理线程池相互独立
+    INGESTION_BATCH_SIZE = 64                                             # 入库时每批向量化并写入Milvus的切片数量，批间检查任务取消
+    INGESTION_PREFETCH_BATCHES = 2                                        # 解析切分线程最多领先向量化写入的批次数，限制入库内存占用
+    INGESTION_MAX_JOBS = 200                                              # 内存中保留的已结束入库任务数量上限
+    BULK_EXTRACT_WORKERS = os.cpu_count() or 1                            # 批量入库时并行解析文本的进程数
+    BULK_PDF_PAGES_PER_TASK = 50                                          # 批量入库时大PDF按该页数拆分为多个解析任务
+    SYNC_ALLOWED_DIRS = []                                                # 允许通过接口同步的目录（绝对路径），为空时禁止接口同步
+    SYNC_HASH_WORKERS = 8                                                 # 目录同步时并行计算文件哈希的线程数
+    SYNC_STATE_DIR = os.path.join(BASE_DIR, "backend/sync_state")         # 目录同步的进行中状态，用于中断后清理与续传
+    UPLOAD_CHUNK_SIZE = 1024 * 1024                                       # 上传文件落盘及计算哈希时每次读取的字节数
+    CHUNK_LENGTH_UNIT = 'token'                                           # 切片长度的计量单位，'token'按嵌入模型分词器的token数，'char'按字符数
+    CHUNK_TOKEN_SIZE = 512                                                # 默认切片长度（token）
+    CHUNK_TOKEN_OVERLAP = 64                                              # 默认切片重叠长度（token）
+    CHUNK_MAX_TOKENS = 8192                                               # 切片长度上限，即嵌入模型的最大输入长度
+    CHUNK_MAX_BYTES = 4096                                                # 切片文本UTF-8编码的最大字节数，即Milvus中chunk_text字段的max_length
+    TOKEN_COUNT_CACHE_MAX_ENTRIES = 200000                                # 文本token数缓存的最大条目数
+    TOKEN_COUNT_CACHE_MAX_MB = 64                                         # 文本token数缓存的最大内存（MB）
 
     # Redis配置
     REDIS_HOST = "localhost"                             # Redis主机地址
     REDIS_PORT = 6379                                    # Redis端口
     REDIS_PASSWORD = "hmis1234."  # Redis密码
-    REDIS_KEY = "document_disabled_key"                            # Redis键
\ No newline at end of file
+    REDIS_KEY = "document_disabled_key"                            # Redis键
+    REDIS_CORPUS_VERSION_KEY = "corpus_version"                    # 知识库版本号的Redis键
\ No newline at end of file
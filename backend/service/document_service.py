@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
 import uuid
-import re
+import json
+import hashlib
+import zipfile
+from concurrent.futures import Executor, Future, as_completed
 from datetime import datetime, timezone
 
-from typing import List
+from typing import Iterable, Iterator, List
 from sqlalchemy.orm import Session
 from sqlalchemy import select, delete, desc, update
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -16,7 +19,13 @@ from service.config import Config
 from db.models import Document
 from utils.logger import logger
 import utils.document_util as document_util
+import utils.text_extraction as text_extraction
+from utils.markdown_parser import MarkdownChunker
+from utils.text_splitter import TokenLengthTextSplitter, split_by_bytes
 from service.milvus_service import milvus_service
+from service.redis_service import redis_service
+from service.llm_cache import llm_response_cache
+from service.token_counter import token_counter
 
 class DocumentService:
     def __init__(self, db: Session):
@@ -27,17 +36,19 @@ class DocumentService:
     def allowed_file(self, filename: str) -> bool:
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
     
-    def save_document(self, file, file_path, file_uuid) -> Document:
+    def save_document(self, file_name, file_path, file_uuid, file_hash=None, file_size=None, source_path=None) -> Document:
         file_extension = file_path.split('.')[-1].lower()
-        _, _, file_hash = document_util.calculate_file_hash(file_path)
+        if file_hash is None:
+            _, _, file_hash = document_util.calculate_file_hash(file_path, Config.UPLOAD_CHUNK_SIZE)
         
         document = Document(
             id=file_uuid,
-            file_name=file.filename,
-            file_size=os.path.getsize(file_path),
+            file_name=file_name,
+            file_size=file_size if file_size is not None else os.path.getsize(file_path),
             file_type=file_extension,
             file_hash=file_hash,
-            upload_time=datetime.now(timezone.utc).isoformat()
+            upload_time=datetime.now(timezone.utc).isoformat(),
+            source_path=source_path
         )
         self.db.add(document)
         self.db.commit()
@@ -57,10 +68,59 @@ class DocumentService:
         result = self.db.execute(stmt).scalars().first()
         return result is not None
     
+    def find_document_by_hash(self, file_hash: str):
+        stmt = select(Document).where(Document.file_hash == file_hash)
+        return self.db.execute(stmt).scalars().first()
+
+    def get_document(self, document_id):
+        try:
+            return self.db.get(Document, uuid.UUID(str(document_id)))
+        except ValueError:
+            return None
+
+    def find_document_by_name(self, file_name: str):
+        '''
+        返回最近上传的同名文档（不含目录同步入库的文档），用于识别重新上传的新版本
+        '''
+        stmt = (
+            select(Document)
+            .where(Document.file_name == file_name, Document.source_path.is_(None))
+            .order_by(desc(Document.upload_time))
+        )
+        return self.db.execute(stmt).scalars().first()
+
+    def save_document_version(self, document: Document, file_path, file_hash, file_size=None) -> Document:
+        '''
+        记录文档的新版本，文档ID与名称不变，版本号递增
+        '''
+        document.file_hash = file_hash
+        document.file_size = file_size if file_size is not None else os.path.getsize(file_path)
+        document.file_type = file_path.split('.')[-1].lower()
+        document.version = (document.version or 1) + 1
+        document.upload_time = datetime.now(timezone.utc).isoformat()
+        self.db.commit()
+        self.db.refresh(document)
+        logger.info(f"文档已更新至版本 {document.version}: {document.file_name}")
+        # 文档内容变化后，引用该文档切片的相关性判断缓存失效
+        llm_response_cache.invalidate_tags([str(document.id)])
+        # 删除文件
+        os.remove(file_path)
+        return document
+
+    def get_synced_documents(self, data_dir: str) -> dict:
+        '''
+        返回目录同步入库的文档，{源文件路径: 文档}
+        '''
+        prefix = os.path.join(data_dir, '')
+        stmt = select(Document).where(Document.source_path.startswith(prefix, autoescape=True))
+        return {document.source_path: document for document in self.db.execute(stmt).scalars().all()}
+
     def update_document_status(self, doc_id: str, status: int) -> bool:
         stmt = update(Document).where(Document.id == doc_id).values(status=status)
         result = self.db.execute(stmt)
         self.db.commit()
+        # 文档状态变化后，引用该文档切片的相关性判断缓存失效
+        llm_response_cache.invalidate_tags([doc_id])
         return result.rowcount > 0
     
     def delete_document(self, doc_id: str) -> bool:
@@ -69,104 +129,520 @@ class DocumentService:
         except Exception as e:
             logger.error(f"删除向量数据库失败: {str(e)}")
             return False
+        redis_service.bump_corpus_version()
+        llm_response_cache.invalidate_tags([doc_id])
         stmt = delete(Document).where(Document.id == doc_id)
         result = self.db.execute(stmt)
         self.db.commit()
         return result.rowcount > 0
     
-    def extract_text(self, file_path: str) -> str:
+    def iter_text(self, file_path: str) -> Iterator[str]:
+        '''
+        按页（PDF）或按块（TXT）逐段产出文档文本，不把整个文档拼接为一个字符串
+        '''
         file_extension = file_path.split('.')[-1].lower()
+        if file_extension == 'pdf':
+            reader = PdfReader(file_path)
+            for page in reader.pages:
+                extracted = page.extract_text()
+                if extracted:
+                    yield extracted + "\n"
+        elif file_extension == 'txt':
+            with open(file_path, 'r', encoding='utf-8') as f:
+                while block := f.read(Config.UPLOAD_CHUNK_SIZE):
+                    yield block
+        elif file_extension in ('md', 'markdown'):
+            # Markdown按行产出，供标题感知切分逐行处理
+            with open(file_path, 'r', encoding='utf-8') as f:
+                yield from f
+        elif file_extension in ('docx', 'doc'):
+            # docx2txt不支持逐段解析，整体提取
+            text = docx2txt.process(file_path)
+            if text:
+                yield text
+
+    def create_text_splitter(self, chunk_size: int, overlap_size: int) -> RecursiveCharacterTextSplitter:
+        '''
+        按Config.CHUNK_LENGTH_UNIT创建切分器：默认以嵌入模型分词器的token数计量切片长度，不超过模型的最大输入长度
+        '''
+        if Config.CHUNK_LENGTH_UNIT == 'token':
+            chunk_size = min(chunk_size, Config.CHUNK_MAX_TOKENS)
+            return TokenLengthTextSplitter(token_counter, chunk_size=chunk_size, chunk_overlap=min(overlap_size, chunk_size), add_start_index=True)
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap_size, add_start_index=True)
+
+    def iter_chunks(self, segments: Iterable[str], text_splitter: RecursiveCharacterTextSplitter) -> Iterator[str]:
+        '''
+        增量切分逐段产出的文本：每段与上一段遗留的原始文本拼接后切分，
+        最后一个切片可能被段边界截断，其原始文本留到下一段一起切分。
+        text_splitter需开启add_start_index以定位遗留文本
+        '''
+        carry = ""
+        for segment in segments:
+            buffer = carry + segment
+            documents = text_splitter.create_documents([buffer])
+            if not documents:
+                carry = ""
+                continue
+            for document in documents[:-1]:
+                yield document.page_content
+            start_index = documents[-1].metadata.get("start_index", -1)
+            carry = buffer[start_index:] if start_index >= 0 else documents[-1].page_content
+        if carry:
+            yield from text_splitter.split_text(carry)
+
+    def split_segments(self, file_path: str, segments: Iterable[str], chunk_size: int, overlap_size: int) -> Iterator[str]:
+        '''
+        Markdown文件按标题层级切分，切片以标题路径开头，标题路径计入切片长度；其他文件按段增量切分。
+        超过chunk_text字段长度上限的切片按字节拆分，保证可以写入Milvus
+        '''
+        if file_path.split('.')[-1].lower() in ('md', 'markdown'):
+            lines = (line for segment in segments for line in segment.splitlines())
+            if Config.CHUNK_LENGTH_UNIT == 'token':
+                chunk_size, length_function = min(chunk_size, Config.CHUNK_MAX_TOKENS), token_counter
+            else:
+                length_function = len
+            chunker = MarkdownChunker(lambda budget: self.create_text_splitter(budget, min(overlap_size, budget)), chunk_size, length_function)
+            chunks = chunker.iter_chunks(lines)
+        else:
+            chunks = self.iter_chunks(segments, self.create_text_splitter(chunk_size, overlap_size))
+        return (piece for chunk in chunks for piece in split_by_bytes(chunk, Config.CHUNK_MAX_BYTES))
+
+    def iter_chunk_batches(self, file_path: str, chunk_size: int, overlap_size: int, progress_callback=None) -> Iterator[List[str]]:
+        chunks = self.split_segments(file_path, self.iter_text(file_path), chunk_size, overlap_size)
+        for batch in document_util.batch_generator(chunks, Config.INGESTION_BATCH_SIZE):
+            if progress_callback is not None:
+                progress_callback("split", len(batch))
+            yield batch
+
+    def save_upload(self, file) -> tuple:
+        '''
+        将上传文件按块流式写入上传目录并同时计算SHA256，返回(文档ID, 文件路径, 文件哈希, 文件大小)
+        '''
+        saved = self.save_stream(file.file, file.filename)
+        return saved["document_uuid"], saved["file_path"], saved["file_hash"], saved["file_size"]
+
+    def save_stream(self, src, file_name: str) -> dict:
+        # 确保上传目录存在
+        os.makedirs(Config.UPLOAD_DIR, exist_ok=True)
+
+        document_uuid = uuid.uuid4()
+        # 生成唯一的文件名
+        file_path = os.path.join(Config.UPLOAD_DIR, f"{document_uuid}_{file_name}")
+        # 保存文件
+        file_hash, file_size = document_util.save_stream_with_hash(src, file_path, Config.UPLOAD_CHUNK_SIZE)
+        return {
+            "file_name": file_name,
+            "file_path": file_path,
+            "document_uuid": document_uuid,
+            "file_hash": file_hash,
+            "file_size": file_size,
+        }
+
+    def save_archive(self, file) -> List[dict]:
+        '''
+        将zip压缩包中支持的文件逐个流式解压到上传目录，返回待入库文件列表
+        '''
+        files = []
+        with zipfile.ZipFile(file.file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                member_name = info.filename
+                # 未标记UTF-8的文件名通常是GBK编码
+                if not info.flag_bits & 0x800:
+                    try:
+                        member_name = member_name.encode('cp437').decode('gbk')
+                    except (UnicodeEncodeError, UnicodeDecodeError):
+                        pass
+                # 只取文件名，忽略压缩包内的目录结构，避免路径穿越
+                file_name = os.path.basename(member_name)
+                if not self.allowed_file(file_name):
+                    continue
+                with archive.open(info) as src:
+                    files.append(self.save_stream(src, file_name))
+        return files
+
+    def is_duplicate_upload(self, file_path, file_name, file_hash) -> bool:
+        '''
+        解析前的去重检查，重复时删除已保存的上传文件
+        '''
+        if not self.get_document_by_hash(file_hash):
+            return False
+        logger.info(f"文件已存在: {file_name}")
+        os.remove(file_path)
+        return True
+
+    def ingest_file(self, file_path, file_name, document_uuid, chunk_size, overlap_size, embedding_model, file_hash=None, file_size=None, progress_callback=None) -> Document:
+        '''
+        解析、切分、向量化并入库已保存的文件，文件已存在时返回None。
+        progress_callback(stage, count)在每批切分('split')、向量化、写入后调用；
+        写入中途失败或被取消时回滚已写入的向量，保留上传文件以便重试
+        '''
         try:
-            if file_extension == 'pdf':
-                # 处理PDF文件
-                reader = PdfReader(file_path)
-                text = ""
-                for page in reader.pages:
-                    extracted = page.extract_text()
-                    if extracted:
-                        text += extracted + "\n"
-                return text if text else "PDF文件无法提取文本内容"
-            
-            elif file_extension == 'txt':
-                # 处理TXT文件
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            
-            elif file_extension == 'docx' or file_extension == 'doc':
-                # 处理DOCX文件
-                text = docx2txt.process(file_path)
-                return text if text else "DOCX文件无法提取文本内容"
-        
-            #替换掉连续的空格、换行符和制表符
-            text = re.sub(r'\s+', ' ', text)
-            # 去除首尾空格
-            text = text.strip()
-        except Exception as e:
-            logger.error(f"提取文档失败: {str(e)}")
-            return f"文件处理失败: {str(e)}"
-    
-    def process_document(self, file, chunk_size, overlap_size, embedding_model) -> Document:
-        try:
-            # 确保上传目录存在
-            os.makedirs(Config.UPLOAD_DIR, exist_ok=True)
-            
-            document_uuid = uuid.uuid4()
-            # 生成唯一的文件名
-            file_name = f"{document_uuid}_{file.filename}"
-            file_path = os.path.join(Config.UPLOAD_DIR, file_name)
-            # 保存文件
-            with open(file_path, "wb") as f:
-                f.write(file.file.read())
-
-            # 查询文件哈希值，是否已经上传
-            _, _,file_hash = document_util.calculate_file_hash(file_path)
-
-            if self.get_document_by_hash(file_hash):
-                logger.info(f"文件已存在: {file.filename}")
-                os.remove(file_path)
-                return None
+            # 查询文件哈希值，是否已经上传；上传时已计算过哈希则直接复用
+            if file_hash is None:
+                _, _, file_hash = document_util.calculate_file_hash(file_path, Config.UPLOAD_CHUNK_SIZE)
 
-            # 根据文档类型提取文本
-            text = self.extract_text(file_path)
-            logger.info(f"成功提取文档，文本长度: {len(text)}")
+            if self.is_duplicate_upload(file_path, file_name, file_hash):
+                return None
 
-            # 分割文本
-            self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap_size)
-            chunks = self.text_splitter.split_text(text)
-            logger.info(f"文本分割完成，共 {len(chunks)} 个块")
+            # 按页提取、增量切分，解析线程与向量化写入并行，最多领先INGESTION_PREFETCH_BATCHES批
+            chunk_batches = document_util.prefetch_generator(
+                self.iter_chunk_batches(file_path, chunk_size, overlap_size, progress_callback),
+                Config.INGESTION_PREFETCH_BATCHES
+            )
             
             # 将文档添加到向量数据库
-            self.milvus_service.create_collection(Config.MILVUS_COLLECTION_NAME, dimension=1024)
+            self.milvus_service.create_collection(Config.MILVUS_COLLECTION_NAME, dimension=Config.EMBEDDING_DIMENSION)
             # 向量化并存储
-            self.milvus_service.add_documents(chunks=chunks, collection_name=Config.MILVUS_COLLECTION_NAME, document_uuid=document_uuid, document_name=file.filename)
+            try:
+                result = self.milvus_service.add_chunk_batches(chunk_batches, collection_name=Config.MILVUS_COLLECTION_NAME, document_uuid=document_uuid, document_name=file_name, progress_callback=progress_callback)
+            except Exception:
+                # 回滚已写入的部分切片，避免重试时主键重复
+                self.milvus_service.delete_documents(Config.MILVUS_COLLECTION_NAME, document_uuid)
+                raise
+            finally:
+                chunk_batches.close()
+            if result["insert_count"] == 0:
+                logger.warning(f"文档未提取到文本内容: {file_name}")
             logger.info("文档已存储至向量数据库")
+            redis_service.bump_corpus_version()
         except Exception as e:
             logger.error(f"文档处理失败: {str(e)}")
             raise e
         # 保存文档
-        document = self.save_document(file, file_path, document_uuid)
+        document = self.save_document(file_name, file_path, document_uuid, file_hash, file_size)
         return document
 
-    async def retrieve(self, query: str, top_k: int = 5) -> List[tuple]:
-        # Step1:查询向量化
-        query_vectors = self.milvus_service.embedding_model.encode_query([query])
+    def reindex_file(self, file_path, file_name, document_id, chunk_size, overlap_size, embedding_model, file_hash=None, file_size=None, progress_callback=None) -> Document:
+        '''
+        以新版本文件更新已有文档：切片ID由内容哈希生成，与Milvus中该文档已有的切片比对，
+        只向量化并写入新增切片、删除已移除的切片，未变化的切片保持不动。内容与已有文档重复时返回None；
+        写入中途失败或被取消时删除本次新增的切片，保留原版本
+        '''
+        document = self.get_document(document_id)
+        if document is None:
+            raise ValueError(f"文档不存在: {document_id}")
+        try:
+            if file_hash is None:
+                _, _, file_hash = document_util.calculate_file_hash(file_path, Config.UPLOAD_CHUNK_SIZE)
+            if self.is_duplicate_upload(file_path, file_name, file_hash):
+                return None
+
+            existing_chunk_ids = self.milvus_service.list_chunk_ids(Config.MILVUS_COLLECTION_NAME, document.id)
+            chunk_batches = document_util.prefetch_generator(
+                self.iter_chunk_batches(file_path, chunk_size, overlap_size, progress_callback),
+                Config.INGESTION_PREFETCH_BATCHES
+            )
+            written_chunk_ids = set()
+            try:
+                # 先写入新增切片再删除移除的切片，更新期间检索不会缺失内容
+                result = self.milvus_service.add_chunk_batches(
+                    chunk_batches, Config.MILVUS_COLLECTION_NAME, progress_callback, existing_chunk_ids, written_chunk_ids,
+                    document_uuid=document.id, document_name=document.file_name
+                )
+                removed_count = self.milvus_service.delete_chunks(Config.MILVUS_COLLECTION_NAME, existing_chunk_ids - result["chunk_ids"])
+            except Exception:
+                # 只删除本次写入的新增切片，原版本的切片不在其中
+                self.milvus_service.delete_chunks(Config.MILVUS_COLLECTION_NAME, written_chunk_ids)
+                raise
+            finally:
+                chunk_batches.close()
+            logger.info(f"文档切片比对完成: {document.file_name}，新增 {result['insert_count']} 个，删除 {removed_count} 个，"
+                        f"保留 {len(existing_chunk_ids) - removed_count} 个")
+            redis_service.bump_corpus_version()
+        except Exception as e:
+            logger.error(f"文档更新失败: {str(e)}")
+            raise e
+        return self.save_document_version(document, file_path, file_hash, file_size)
+
+    def submit_extraction(self, file_path: str, extraction_pool: Executor) -> List[Future]:
+        '''
+        提交文件的解析任务，大PDF按BULK_PDF_PAGES_PER_TASK页拆分，返回按页顺序排列的任务列表
+        '''
+        if file_path.split('.')[-1].lower() != 'pdf':
+            return [extraction_pool.submit(text_extraction.extract_file_segments, file_path)]
+        page_count = text_extraction.count_pdf_pages(file_path)
+        pages_per_task = Config.BULK_PDF_PAGES_PER_TASK
+        return [
+            extraction_pool.submit(text_extraction.extract_pdf_pages, file_path, start, start + pages_per_task)
+            for start in range(0, page_count, pages_per_task)
+        ]
+
+    def ingest_bulk(self, files: List[dict], chunk_size, overlap_size, embedding_model, extraction_pool: Executor, progress_callback=None, file_callback=None) -> List[Document]:
+        '''
+        批量入库：文件及大PDF的页范围在进程池中并行解析，文本回到当前线程统一切分，
+        不同文件的切片组成共享的向量化批次写入，相同文本只编码一次。
+        files中每项含file_name、file_path、document_uuid、file_hash、file_size，含replace_document_id时作为该文档的新版本按切片比对更新；
+        file_callback(file, status, error)在单个文件结束时调用，status为'succeeded'、'duplicate'或'failed'；
+        写入失败或被取消时回滚已写入但尚未保存的文档向量并抛出异常
+        '''
+        def finish(file, status, error=None):
+            if file_callback is not None:
+                file_callback(file, status, error)
+
+        # 解析前去重：库中已有的文件及本批内内容相同的文件
+        pending, seen_hashes = [], set()
+        for file in files:
+            if file["file_hash"] in seen_hashes:
+                logger.info(f"文件已存在: {file['file_name']}")
+                os.remove(file["file_path"])
+                finish(file, "duplicate")
+            elif self.is_duplicate_upload(file["file_path"], file["file_name"], file["file_hash"]):
+                finish(file, "duplicate")
+            else:
+                seen_hashes.add(file["file_hash"])
+                pending.append(file)
+        if not pending:
+            return []
+
+        self.milvus_service.create_collection(Config.MILVUS_COLLECTION_NAME, dimension=Config.EMBEDDING_DIMENSION)
+        batch_size = Config.INGESTION_BATCH_SIZE
+
+        # 按文件、按页范围提交解析任务
+        part_futures = {}
+        part_counts = [0] * len(pending)
+        part_results = [{} for _ in pending]
+        failed = set()
+        for file_index, file in enumerate(pending):
+            try:
+                futures = self.submit_extraction(file["file_path"], extraction_pool)
+            except Exception as e:
+                logger.error(f"提取文档失败: {file['file_name']} {str(e)}")
+                failed.add(file_index)
+                finish(file, "failed", str(e))
+                continue
+            part_counts[file_index] = len(futures)
+            for part_index, future in enumerate(futures):
+                part_futures[future] = (file_index, part_index)
+
+        rows, row_files = [], []
+        remaining = [0] * len(pending)
+        targets = [None] * len(pending)
+        existing_chunk_ids = [set() for _ in pending]
+        chunk_ids = [set() for _ in pending]
+        written_chunk_ids = [set() for _ in pending]
+        split_files, saved_files = set(), set()
+        documents = []
 
-        # Step2:混合检索
-        hit_results = self.milvus_service.search_by_vector(query, query_vectors, Config.MILVUS_COLLECTION_NAME, top_k)
+        def finalize_ready():
+            # 切分完成且全部切片已写入的文件保存到数据库
+            for file_index in sorted(split_files - saved_files):
+                if remaining[file_index] == 0:
+                    file = pending[file_index]
+                    if targets[file_index] is not None:
+                        self.milvus_service.delete_chunks(Config.MILVUS_COLLECTION_NAME, existing_chunk_ids[file_index] - chunk_ids[file_index])
+                        documents.append(self.save_document_version(targets[file_index], file["file_path"], file["file_hash"], file["file_size"]))
+                    else:
+                        documents.append(self.save_document(file["file_name"], file["file_path"], file["document_uuid"], file["file_hash"], file["file_size"], file.get("source_path")))
+                    saved_files.add(file_index)
+                    finish(file, "succeeded")
 
-        # Step3:重排序
-        result_texts = [hit.get('entity').get("chunk_text") for hit in hit_results]  # 文本内容
-        content2doc_name = {hit.get('entity').get("chunk_text"): hit.get('entity').get("document_name") for hit in hit_results}  # 文本内容到文档名称的映射
+        def flush(limit):
+            batch, batch_files = rows[:limit], row_files[:limit]
+            del rows[:limit], row_files[:limit]
+            for row, file_index in zip(batch, batch_files):
+                written_chunk_ids[file_index].add(row["chunk_id"])
+            self.milvus_service.insert_chunk_rows(batch, Config.MILVUS_COLLECTION_NAME, progress_callback)
+            for file_index in batch_files:
+                remaining[file_index] -= 1
 
-        results = self.milvus_service.reranker(query, result_texts, top_k=top_k)
-        doc_names = [content2doc_name.get(hit.text) for hit in results if content2doc_name.get(hit.text)]
-        unique_doc_names = list(dict.fromkeys(doc_names))
-        references = unique_doc_names
+        def complete_file(file_index):
+            # 文件全部页范围解析完成，按页顺序增量切分后并入共享批次
+            file = pending[file_index]
+            results = part_results[file_index]
+            segments = (segment for part_index in range(part_counts[file_index]) for segment in results.pop(part_index))
+            document_uuid, document_name = file["document_uuid"], file["file_name"]
+            if file.get("replace_document_id") is not None:
+                # 新版本只写入新增切片，未变化的切片保持不动；被更新的文档在提交后已删除时按新文档入库
+                targets[file_index] = self.get_document(file["replace_document_id"])
+                if targets[file_index] is None:
+                    logger.warning(f"待更新的文档已不存在，按新文档入库: {file['file_name']}")
+                else:
+                    document_uuid, document_name = targets[file_index].id, targets[file_index].file_name
+                    existing_chunk_ids[file_index] = self.milvus_service.list_chunk_ids(Config.MILVUS_COLLECTION_NAME, document_uuid)
+            split_files.add(file_index)
+            chunk_count = 0
+            for chunk in self.split_segments(file["file_path"], segments, chunk_size, overlap_size):
+                chunk_count += 1
+                chunk_id = self.milvus_service.make_chunk_id(document_uuid, chunk)
+                if chunk_id in chunk_ids[file_index]:
+                    continue
+                chunk_ids[file_index].add(chunk_id)
+                if chunk_id in existing_chunk_ids[file_index]:
+                    continue
+                rows.append({
+                    "chunk_id": chunk_id,
+                    "document_id": str(document_uuid),
+                    "document_name": document_name,
+                    "chunk_text": chunk,
+                })
+                row_files.append(file_index)
+                remaining[file_index] += 1
+                if len(rows) >= batch_size:
+                    flush(batch_size)
+            logger.info(f"文本分割完成: {file['file_name']}，共 {chunk_count} 个块")
+            if progress_callback is not None:
+                progress_callback("split", chunk_count)
+            finalize_ready()
+
+        try:
+            # 没有可解析页面的文件直接完成
+            for file_index in range(len(pending)):
+                if part_counts[file_index] == 0 and file_index not in failed:
+                    complete_file(file_index)
+            for future in as_completed(part_futures):
+                file_index, part_index = part_futures[future]
+                if file_index in failed:
+                    continue
+                try:
+                    part_results[file_index][part_index] = future.result()
+                except Exception as e:
+                    logger.error(f"提取文档失败: {pending[file_index]['file_name']} {str(e)}")
+                    failed.add(file_index)
+                    part_results[file_index].clear()
+                    finish(pending[file_index], "failed", str(e))
+                    continue
+                if len(part_results[file_index]) == part_counts[file_index]:
+                    complete_file(file_index)
+            while rows:
+                flush(batch_size)
+            finalize_ready()
+        except Exception:
+            # 回滚已开始写入但尚未保存的文档，新版本只删除本次新增的切片
+            for file_index in split_files - saved_files:
+                if targets[file_index] is not None:
+                    self.milvus_service.delete_chunks(Config.MILVUS_COLLECTION_NAME, written_chunk_ids[file_index])
+                else:
+                    self.milvus_service.delete_documents(Config.MILVUS_COLLECTION_NAME, pending[file_index]["document_uuid"])
+            raise
+        finally:
+            for future in part_futures:
+                future.cancel()
+            if documents:
+                redis_service.bump_corpus_version()
+        logger.info(f"批量入库完成，共 {len(documents)} 个文档")
+        return documents
+
+    def prepare_sync(self, data_dir: str) -> tuple:
+        '''
+        目录增量同步的准备阶段：并行计算目录清单，与documents表比对后删除已移除文件的文档，
+        内容变化的文件作为原文档的新版本按切片比对更新，新增及变化的文件复制到上传目录作为快照，返回(待入库文件列表, 统计)。
+        待入库文件写入同步状态，入库结束或下次同步开始时由finish_sync清理，中断后重新同步即可续传
+        '''
+        data_dir = os.path.abspath(data_dir)
+        if not os.path.isdir(data_dir):
+            raise ValueError(f"目录不存在: {data_dir}")
+        # 清理上次中断遗留的未保存向量与文件快照
+        self.finish_sync(data_dir)
+
+        current_files = document_util.get_current_files(data_dir, Config.ALLOWED_EXTENSIONS, Config.SYNC_HASH_WORKERS)
+        synced_documents = self.get_synced_documents(data_dir)
+        summary = {"total": len(current_files), "new": 0, "changed": 0, "unchanged": 0, "skipped": 0}
+        summary["deleted"] = document_util.delete_removed_files(self, synced_documents, current_files)
+
+        files = []
+        for source_path, (file_hash, _) in sorted(current_files.items()):
+            document = synced_documents.get(source_path)
+            if document is not None and document.file_hash == file_hash:
+                summary["unchanged"] += 1
+                continue
+            if document is None:
+                existing = self.find_document_by_hash(file_hash)
+                if existing is not None:
+                    # 内容已通过上传入库的文件直接关联源路径，不重复入库
+                    if existing.source_path is None:
+                        existing.source_path = source_path
+                        self.db.commit()
+                        summary["unchanged"] += 1
+                    else:
+                        summary["skipped"] += 1
+                    continue
+                summary["new"] += 1
+            else:
+                summary["changed"] += 1
+            with open(source_path, "rb") as src:
+                saved = self.save_stream(src, os.path.basename(source_path))
+            files.append({
+                **saved,
+                "source_path": source_path,
+                "replace_document_id": str(document.id) if document is not None else None,
+            })
+
+        self.write_sync_state(data_dir, files)
+        logger.info(f"目录同步清单: {data_dir} {summary}")
+        return files, summary
+
+    def finish_sync(self, data_dir: str):
+        '''
+        清理同步状态：删除未保存文档已写入的向量及遗留的文件快照
+        '''
+        state_path = self.get_sync_state_path(os.path.abspath(data_dir))
+        if not os.path.exists(state_path):
+            return
+        with open(state_path, "r", encoding="utf-8") as f:
+            pending_files = json.load(f)
+        for file in pending_files:
+            if self.db.get(Document, uuid.UUID(file["document_uuid"])) is None:
+                self.milvus_service.delete_documents(Config.MILVUS_COLLECTION_NAME, file["document_uuid"])
+            if os.path.exists(file["file_path"]):
+                os.remove(file["file_path"])
+        os.remove(state_path)
+
+    def write_sync_state(self, data_dir: str, files: List[dict]):
+        os.makedirs(Config.SYNC_STATE_DIR, exist_ok=True)
+        state = [{"document_uuid": str(file["document_uuid"]), "file_path": file["file_path"]} for file in files]
+        with open(self.get_sync_state_path(data_dir), "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+
+    def get_sync_state_path(self, data_dir: str) -> str:
+        return os.path.join(Config.SYNC_STATE_DIR, hashlib.sha256(data_dir.encode("utf-8")).hexdigest()[:16] + ".json")
+
+    async def search_candidates(self, queries: List[str], top_k: int = 5) -> List[List[dict]]:
+        '''
+        返回与queries顺序一致的候选切片列表
+        '''
+        if not queries:
+            return []
+        # Step1:所有问题一次向量化
+        query_vectors = await self.milvus_service.async_encode_query(queries)
+
+        # Step2:一次nq=len(queries)的混合检索（异步Milvus客户端）
+        hit_results_list = await self.milvus_service.async_search_by_vectors(queries, query_vectors, Config.MILVUS_COLLECTION_NAME, top_k)
+        return [
+            [
+                {
+                    "chunk_id": hit.get('id'),
+                    "doc_id": hit.get('entity').get("document_id"),
+                    "text": hit.get('entity').get("chunk_text"),
+                    "doc_name": hit.get('entity').get("document_name")
+                } for hit in hit_results
+            ] for hit_results in hit_results_list
+        ]
+
+    def merge_candidates(self, candidate_lists: List[List[dict]]) -> List[dict]:
+        '''
+        合并多个子问题的候选切片，按chunk_id去重并保持首次出现的顺序
+        '''
+        merged = {}
+        for candidates in candidate_lists:
+            for candidate in candidates:
+                merged.setdefault(candidate["chunk_id"], candidate)
+        return list(merged.values())
+
+    async def rerank_candidates(self, query: str, candidates: List[dict]) -> tuple:
+        if not candidates:
+            return [], []
+        # Step3:对候选并集做一次批量重排序，已缓存的(查询, 切片)分数直接复用
+        scores = await self.milvus_service.async_rerank_chunks(
+            query,
+            [candidate["chunk_id"] for candidate in candidates],
+            [candidate["text"] for candidate in candidates]
+        )
+        chunks = sorted(
+            ({**candidate, "score": score} for candidate, score in zip(candidates, scores)),
+            key=lambda chunk: chunk["score"], reverse=True
+        )
+        references = list(dict.fromkeys(chunk["doc_name"] for chunk in chunks if chunk["doc_name"]))
         # Step4:返回结果
-        return  [
-                    {
-                        "text": hit.text,
-                        "score": hit.score,
-                        "doc_name": content2doc_name.get(hit.text)
-                    } for hit in results
-                ], references
\ No newline at end of file
+        return chunks, references
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+from utils.logger import logger
+
+
+class EmbeddingBatcher:
+    '''
+    跨请求的查询向量化微批调度器。
+    并发的encode请求先进入队列，后台线程按最大批大小或最长等待时间凑批，一次前向计算后分别回填每个调用方的Future。
+    '''
+    def __init__(self, encode_fn: Callable, max_batch_size: int = 32, max_wait_ms: float = 5, name: str = "embedding-batcher"):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def submit_many(self, texts: List[str]) -> List[Future]:
+        return [self.submit(text) for text in texts]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        # 跳过调用方已取消的请求
+        batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            vectors = self.encode_fn([text for text, _ in batch])['dense']
+        except Exception as e:
+            logger.error(f"批量向量化失败: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
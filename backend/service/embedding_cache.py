@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+from typing import List, Optional
+
+import numpy as np
+
+from service.config import Config
+from service.redis_service import redis_service
+from utils.cache_util import BoundedLRUCache, normalize_query
+from utils.logger import logger
+
+
+class QueryEmbeddingCache:
+    '''
+    查询稠密向量缓存，键为归一化后的查询文本。
+    本地为条目数与内存双重受限的LRU，可选Redis作为多实例共享的二级缓存。
+    '''
+    def __init__(self, model_id: str, max_entries: int, max_bytes: int, redis_enabled: bool = False, redis_ttl: int = None):
+        self.model_id = model_id
+        self.local = BoundedLRUCache(max_entries=max_entries, max_bytes=max_bytes, sizeof=lambda vector: vector.nbytes)
+        self.redis_enabled = redis_enabled
+        self.redis_ttl = redis_ttl
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def make_key(self, text: str) -> str:
+        return normalize_query(text)
+
+    def get_local(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        return [self.local.get(self.make_key(text)) for text in texts]
+
+    def get_remote(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        '''
+        查询Redis二级缓存，命中的向量同时回填本地缓存
+        '''
+        if not self.redis_enabled or not texts:
+            return [None] * len(texts)
+        keys = [self.make_key(text) for text in texts]
+        try:
+            values = redis_service.client.mget([self._redis_key(key) for key in keys])
+        except Exception as e:
+            logger.warning(f"读取Redis查询向量缓存失败: {e}")
+            return [None] * len(texts)
+
+        vectors = []
+        for key, value in zip(keys, values):
+            if value is None:
+                self.redis_misses += 1
+                vectors.append(None)
+                continue
+            self.redis_hits += 1
+            vector = np.frombuffer(base64.b64decode(value), dtype=np.float32)
+            self.local.put(key, vector)
+            vectors.append(vector)
+        return vectors
+
+    def put_many(self, texts: List[str], vectors: List[np.ndarray]):
+        entries = {}
+        for text, vector in zip(texts, vectors):
+            key = self.make_key(text)
+            vector = np.asarray(vector, dtype=np.float32)
+            self.local.put(key, vector)
+            entries[self._redis_key(key)] = base64.b64encode(vector.tobytes()).decode('ascii')
+        if not self.redis_enabled or not entries:
+            return
+        try:
+            pipeline = redis_service.client.pipeline(transaction=False)
+            for redis_key, value in entries.items():
+                pipeline.set(redis_key, value, ex=self.redis_ttl)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"写入Redis查询向量缓存失败: {e}")
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats.update({"redis_enabled": self.redis_enabled, "redis_hits": self.redis_hits, "redis_misses": self.redis_misses})
+        return stats
+
+    def _redis_key(self, key: str) -> str:
+        digest = hashlib.sha1(f"{self.model_id}\0{key}".encode()).hexdigest()
+        return f"{Config.EMBEDDING_CACHE_REDIS_PREFIX}:{digest}"
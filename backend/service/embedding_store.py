@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Callable, List
+
+import numpy as np
+
+from utils.logger import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，只能由单个进程写入存储
+    fcntl = None
+
+
+class ChunkEmbeddingStore:
+    '''
+    内容寻址的切片向量持久化存储，键为 sha256(模型标识 + 切片文本)。
+    向量顺序追加到float32矩阵文件中并以内存映射方式读取，索引文件每行记录"键\\t行号"。
+    入库时只对从未出现过的切片进行向量化。
+    多个进程（多个uvicorn worker、scripts/sync_directory.py）可共用同一存储：写入时持有存储目录下的文件锁，
+    并先读入其他进程追加的索引，再在已索引的向量之后追加；其他进程新写入的向量在下次写入时才可见。
+    '''
+    def __init__(self, store_dir: str, model_id: str, dimension: int):
+        self.store_dir = store_dir
+        self.model_id = model_id
+        self.dimension = dimension
+        model_dir = hashlib.sha1(model_id.encode()).hexdigest()[:12]
+        os.makedirs(os.path.join(store_dir, model_dir), exist_ok=True)
+        self.vectors_path = os.path.join(store_dir, model_dir, "vectors.f32")
+        self.index_path = os.path.join(store_dir, model_dir, "index.tsv")
+        self.lock_path = os.path.join(store_dir, model_dir, "store.lock")
+        self.row_bytes = dimension * np.dtype(np.float32).itemsize
+        self._lock = threading.Lock()
+        self._index = {}
+        # 已被索引引用的向量行数，及已读取到的索引文件字节偏移
+        self._rows = 0
+        self._index_offset = 0
+        self._matrix = None
+        with self._lock, self._file_lock():
+            self._read_index()
+            self._truncate_tails()
+        logger.info(f"切片向量存储已加载 {len(self._index)} 条记录")
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode()).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List:
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            rows = [self._index.get(key) for key in keys]
+            if any(row is not None for row in rows):
+                matrix = self._get_matrix()
+            return [np.array(matrix[row]) if row is not None else None for row in rows]
+
+    def put_many(self, texts: List[str], vectors: List):
+        with self._lock, self._file_lock():
+            # 先读入其他进程追加的记录，已存在的切片不再重复写入
+            self._read_index()
+            new_entries = {}
+            for text, vector in zip(texts, vectors):
+                key = self.make_key(text)
+                if key not in self._index and key not in new_entries:
+                    new_entries[key] = np.asarray(vector, dtype=np.float32)
+            if not new_entries:
+                return
+            self._truncate_tails()
+            start_row = self._rows
+            # 先写向量再写索引，进程中断时索引不会指向不完整的向量
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack(list(new_entries.values())).tobytes())
+            lines = "".join(f"{key}\t{start_row + offset}\n" for offset, key in enumerate(new_entries)).encode("utf-8")
+            with open(self.index_path, "ab") as f:
+                f.write(lines)
+            for offset, key in enumerate(new_entries):
+                self._index[key] = start_row + offset
+            self._rows = start_row + len(new_entries)
+            self._index_offset += len(lines)
+            self._matrix = None
+
+    def encode_with_store(self, texts: List[str], encode_fn: Callable[[List[str]], List]) -> List:
+        '''
+        先查存储，仅对未命中的切片调用encode_fn，结果写回存储后按原顺序返回
+        '''
+        vectors = self.get_many(texts)
+        miss_indexes = [i for i, vector in enumerate(vectors) if vector is None]
+        if miss_indexes:
+            encoded = encode_fn([texts[i] for i in miss_indexes])
+            self.put_many([texts[i] for i in miss_indexes], encoded)
+            for i, vector in zip(miss_indexes, encoded):
+                vectors[i] = vector
+        logger.info(f"切片向量存储命中 {len(texts) - len(miss_indexes)} 个，新编码 {len(miss_indexes)} 个")
+        return vectors
+
+    def __len__(self):
+        return len(self._index)
+
+    @contextmanager
+    def _file_lock(self):
+        # 跨进程的写锁，与self._lock配合使用
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _get_matrix(self):
+        # 调用方需持有self._lock
+        if self._matrix is None:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self._rows, self.dimension))
+        return self._matrix
+
+    def _read_index(self):
+        # 调用方需持有self._lock及文件锁；从上次读取的位置继续，只接受以换行结尾的完整行
+        if not os.path.exists(self.index_path):
+            return
+        vector_rows = os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                # 中断写入产生的不完整末行，其行号可能被截断，不能使用
+                if not line.endswith(b"\n"):
+                    break
+                self._index_offset += len(line)
+                parts = line.decode("utf-8", errors="replace").rstrip("\n").split("\t")
+                if len(parts) != 2 or not parts[1].isdigit() or int(parts[1]) >= vector_rows:
+                    continue
+                row = int(parts[1])
+                self._index[parts[0]] = row
+                self._rows = max(self._rows, row + 1)
+        self._matrix = None
+
+    def _truncate_tails(self):
+        # 调用方需持有self._lock及文件锁；截掉中断写入遗留的不完整索引行及未被索引引用的尾部向量，保证行号与文件偏移一致
+        if os.path.exists(self.index_path) and os.path.getsize(self.index_path) > self._index_offset:
+            with open(self.index_path, "r+b") as f:
+                f.truncate(self._index_offset)
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > self._rows * self.row_bytes:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(self._rows * self.row_bytes)
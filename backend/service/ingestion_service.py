@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import uuid
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from db.database import SessionLocal
+from service.config import Config
+from service.document_service import DocumentService
+from utils.logger import logger
+
+
+class IngestionCancelled(Exception):
+    pass
+
+
+class IngestionJob:
+    '''
+    一次文档入库任务，状态依次为queued -> running -> succeeded/duplicate/failed/cancelled
+    '''
+    FINISHED_STATUSES = {"succeeded", "duplicate", "failed", "cancelled"}
+
+    def __init__(self, file_name: str, file_path: str, document_uuid, chunk_size: int, overlap_size: int, embedding_model: str,
+                 file_hash: Optional[str] = None, file_size: Optional[int] = None, replace_document_id=None):
+        self.job_id = str(uuid.uuid4())
+        self.file_name = file_name
+        self.file_path = file_path
+        # 上传已有文档的新版本时，任务对应被更新的文档
+        self.replace = replace_document_id is not None
+        self.document_uuid = replace_document_id if self.replace else document_uuid
+        self.file_hash = file_hash
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.overlap_size = overlap_size
+        self.embedding_model = embedding_model
+        self.status = "queued"
+        self.error = None
+        self.attempts = 0
+        self.created_at = datetime.now(timezone.utc)
+        self.updated_at = self.created_at
+        self.future = None
+        self.cancel_event = threading.Event()
+        self.reset_progress()
+
+    def reset_progress(self):
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_inserted = 0
+        self.chunks_unchanged = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.FINISHED_STATUSES
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        self.status = status
+        self.error = error
+        self.updated_at = datetime.now(timezone.utc)
+
+    def on_progress(self, stage: str, count: int):
+        # 每个批次前后检查取消标记，已写入的向量由DocumentService回滚
+        if self.cancel_event.is_set():
+            raise IngestionCancelled(f"入库任务已取消: {self.job_id}")
+        # 解析切分与写入流水线并行，chunks_total为目前已切分出的切片数
+        if stage == "split":
+            self.chunks_total += count
+        elif stage == "embedded":
+            self.chunks_embedded += count
+        elif stage == "inserted":
+            self.chunks_inserted += count
+        elif stage == "unchanged":
+            self.chunks_unchanged += count
+        self.updated_at = datetime.now(timezone.utc)
+
+    def file_hashes(self) -> List[str]:
+        return [self.file_hash]
+
+    def file_paths(self) -> List[str]:
+        return [self.file_path]
+
+    def check_retry(self):
+        if not os.path.exists(self.file_path):
+            raise ValueError("上传文件已不存在，请重新上传")
+
+    def run(self, document_service: DocumentService, ingestion_service: "IngestionService"):
+        ingest = document_service.reindex_file if self.replace else document_service.ingest_file
+        document = ingest(
+            self.file_path, self.file_name, self.document_uuid,
+            self.chunk_size, self.overlap_size, self.embedding_model,
+            file_hash=self.file_hash, file_size=self.file_size,
+            progress_callback=self.on_progress
+        )
+        self.set_status("succeeded" if document is not None else "duplicate")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "document_id": str(self.document_uuid) if self.document_uuid is not None else None,
+            "file_name": self.file_name,
+            "status": self.status,
+            "error": self.error,
+            "attempts": self.attempts,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_inserted": self.chunks_inserted,
+            "chunks_unchanged": self.chunks_unchanged,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class BulkIngestionJob(IngestionJob):
+    '''
+    批量入库任务，files中每项为DocumentService.save_stream返回的文件信息，并记录单个文件的状态
+    '''
+    def __init__(self, files: List[dict], chunk_size: int, overlap_size: int, embedding_model: str):
+        super().__init__(f"{len(files)}个文件", None, None, chunk_size, overlap_size, embedding_model)
+        self.files = [{**file, "status": "queued", "error": None} for file in files]
+
+    def file_hashes(self) -> List[str]:
+        return [file["file_hash"] for file in self.files if file["status"] == "queued"]
+
+    def file_paths(self) -> List[str]:
+        return [file["file_path"] for file in self.files if file["status"] not in ("succeeded", "duplicate")]
+
+    def check_retry(self):
+        for file in self.files:
+            if file["status"] not in ("succeeded", "duplicate"):
+                file["status"], file["error"] = "queued", None
+
+    def on_file_finished(self, file: dict, status: str, error: Optional[str] = None):
+        file["status"], file["error"] = status, error
+        self.updated_at = datetime.now(timezone.utc)
+
+    def run(self, document_service: DocumentService, ingestion_service: "IngestionService"):
+        # 中途失败或取消时，未完成的文件保持queued，重试时只处理未成功的文件
+        pending = [file for file in self.files if file["status"] == "queued"]
+        document_service.ingest_bulk(
+            pending, self.chunk_size, self.overlap_size, self.embedding_model,
+            ingestion_service.get_extraction_pool(),
+            progress_callback=self.on_progress, file_callback=self.on_file_finished
+        )
+        failed_files = [file for file in self.files if file["status"] == "failed"]
+        if failed_files:
+            self.set_status("failed", f"{len(failed_files)}个文件处理失败")
+        else:
+            self.set_status("succeeded")
+
+    def to_dict(self) -> dict:
+        return {
+            **super().to_dict(),
+            "files": [
+                {
+                    "file_name": file["file_name"],
+                    "document_id": str(file["document_uuid"]),
+                    "status": file["status"],
+                    "error": file["error"],
+                } for file in self.files
+            ],
+        }
+
+
+class SyncIngestionJob(BulkIngestionJob):
+    '''
+    目录增量同步任务，运行时计算目录清单，新增及变化的文件走批量入库流程；重试即重新同步，已完成的文件不会重复处理
+    '''
+    def __init__(self, data_dir: str, chunk_size: int, overlap_size: int, embedding_model: str):
+        super().__init__([], chunk_size, overlap_size, embedding_model)
+        self.data_dir = data_dir
+        self.file_name = data_dir
+        self.summary = None
+
+    def check_retry(self):
+        self.files = []
+
+    def run(self, document_service: DocumentService, ingestion_service: "IngestionService"):
+        files, self.summary = document_service.prepare_sync(self.data_dir)
+        self.files = [{**file, "status": "queued", "error": None} for file in files]
+        super().run(document_service, ingestion_service)
+        document_service.finish_sync(self.data_dir)
+
+    def to_dict(self) -> dict:
+        return {**super().to_dict(), "summary": self.summary}
+
+
+class IngestionService:
+    '''
+    后台文档入库队列：上传接口保存文件后立即返回任务ID，解析、切分、向量化与写入由独立的有界线程池执行，
+    不占用查询推理线程池；每个任务使用独立的数据库会话
+    '''
+    def __init__(self, max_workers: int, max_jobs: int):
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="ingestion"
+        )
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._extraction_pool = None
+
+    def get_extraction_pool(self) -> ProcessPoolExecutor:
+        '''
+        批量入库的文本解析进程池，首次使用时创建；使用spawn方式启动，避免fork出持有模型与连接的进程
+        '''
+        with self._lock:
+            if self._extraction_pool is None:
+                self._extraction_pool = ProcessPoolExecutor(
+                    max_workers=Config.BULK_EXTRACT_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._extraction_pool
+
+    def submit(self, file_name: str, file_path: str, document_uuid, chunk_size: int, overlap_size: int, embedding_model: str,
+               file_hash: Optional[str] = None, file_size: Optional[int] = None, replace_document_id=None) -> IngestionJob:
+        job = IngestionJob(file_name, file_path, document_uuid, chunk_size, overlap_size, embedding_model, file_hash, file_size, replace_document_id)
+        return self._submit_job(job)
+
+    def submit_bulk(self, files: List[dict], chunk_size: int, overlap_size: int, embedding_model: str) -> BulkIngestionJob:
+        return self._submit_job(BulkIngestionJob(files, chunk_size, overlap_size, embedding_model))
+
+    def submit_sync(self, data_dir: str, chunk_size: int, overlap_size: int, embedding_model: str) -> SyncIngestionJob:
+        with self._lock:
+            if any(isinstance(job, SyncIngestionJob) and job.data_dir == data_dir and not job.finished for job in self._jobs.values()):
+                raise ValueError(f"目录正在同步中: {data_dir}")
+        return self._submit_job(SyncIngestionJob(data_dir, chunk_size, overlap_size, embedding_model))
+
+    def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    def has_active_hash(self, file_hash: str) -> bool:
+        '''
+        是否已有相同内容的文件在排队或入库中，用于上传时的提前去重
+        '''
+        with self._lock:
+            return any(file_hash in job.file_hashes() for job in self._jobs.values() if not job.finished)
+
+    def has_active_document(self, document_id) -> bool:
+        '''
+        是否已有更新该文档的任务在排队或执行中
+        '''
+        with self._lock:
+            return any(job.replace and str(job.document_uuid) == str(document_id) for job in self._jobs.values() if not job.finished)
+
+    def list_jobs(self) -> List[IngestionJob]:
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def cancel(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.cancel_event.set()
+            # 尚未开始执行的任务直接取消，执行中的任务在下一个批次边界中止
+            if job.future is not None and job.future.cancel():
+                job.set_status("cancelled")
+            return job
+
+    def retry(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status not in ("failed", "cancelled"):
+                raise ValueError(f"任务状态为{job.status}，无法重试")
+            job.check_retry()
+            job.cancel_event.clear()
+            job.reset_progress()
+            job.set_status("queued")
+            self._jobs.move_to_end(job_id)
+            self._schedule(job)
+        logger.info(f"入库任务已重新提交: {job_id}")
+        return job
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self._extraction_pool is not None:
+            self._extraction_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit_job(self, job: IngestionJob) -> IngestionJob:
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict_finished()
+            self._schedule(job)
+        logger.info(f"入库任务已提交: {job.job_id} {job.file_name}")
+        return job
+
+    def _schedule(self, job: IngestionJob):
+        job.future = self.executor.submit(self._run, job)
+
+    def _run(self, job: IngestionJob):
+        with self._lock:
+            if job.cancel_event.is_set():
+                job.set_status("cancelled")
+                return
+            job.attempts += 1
+            job.set_status("running")
+
+        db = SessionLocal()
+        try:
+            job.run(DocumentService(db), self)
+            logger.info(f"入库任务完成: {job.job_id} {job.status}")
+        except IngestionCancelled:
+            job.set_status("cancelled")
+            logger.info(f"入库任务已取消: {job.job_id}")
+        except Exception as e:
+            job.set_status("failed", str(e))
+            logger.error(f"入库任务失败: {job.job_id} {str(e)}")
+        finally:
+            db.close()
+
+    def _evict_finished(self):
+        # 仅淘汰已结束的最早任务，失败或取消任务残留的上传文件一并清理
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+            job = self._jobs.pop(job_id)
+            for file_path in job.file_paths():
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+
+ingestion_service = IngestionService(max_workers=Config.INGESTION_WORKERS, max_jobs=Config.INGESTION_MAX_JOBS)
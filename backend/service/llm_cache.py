@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import sys
+from typing import List, Optional
+
+from service.config import Config
+from service.redis_service import redis_service
+from utils.cache_util import BoundedLRUCache
+from utils.logger import logger
+
+
+class LLMResponseCache:
+    '''
+    确定性LLM子调用（问题重写、相关性判断）的结果缓存，键为模型、消息与采样参数的哈希。
+    本地为带过期时间的LRU，可选Redis作为共享二级缓存；条目可携带标签（文档ID），文档删除或禁用时按标签失效。
+    '''
+    def __init__(self, max_entries: int, max_bytes: int, ttl: int, redis_enabled: bool = False):
+        self.local = BoundedLRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                                     sizeof=lambda value: sys.getsizeof(value[0]) + 64 * len(value[1]))
+        self.ttl = ttl
+        self.redis_enabled = redis_enabled
+        self.redis_hits = 0
+        self.redis_misses = 0
+
+    def make_key(self, payload: dict, extra_body: Optional[dict] = None) -> str:
+        key_fields = {field: value for field, value in payload.items() if field != "stream"}
+        key_fields["extra_body"] = extra_body
+        return hashlib.sha256(json.dumps(key_fields, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.local.get(key)
+        if value is not None:
+            return value[0]
+        if not self.redis_enabled:
+            return None
+        try:
+            value = redis_service.client.get(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"读取Redis LLM缓存失败: {e}")
+            return None
+        if value is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = json.loads(value)
+        self.local.put(key, (value["content"], tuple(value["tags"])))
+        return value["content"]
+
+    def put(self, key: str, content: str, tags: List[str] = ()):
+        tags = tuple(str(tag) for tag in tags)
+        self.local.put(key, (content, tags))
+        if not self.redis_enabled:
+            return
+        try:
+            pipeline = redis_service.client.pipeline(transaction=False)
+            pipeline.set(self._redis_key(key), json.dumps({"content": content, "tags": tags}, ensure_ascii=False), ex=self.ttl)
+            for tag in tags:
+                pipeline.sadd(self._redis_tag_key(tag), key)
+                pipeline.expire(self._redis_tag_key(tag), self.ttl)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"写入Redis LLM缓存失败: {e}")
+
+    def invalidate_tags(self, tags: List[str]) -> int:
+        tags = {str(tag) for tag in tags}
+        removed = self.local.discard_if(lambda key, value: not tags.isdisjoint(value[1]))
+        if self.redis_enabled:
+            try:
+                for tag in tags:
+                    keys = redis_service.client.smembers(self._redis_tag_key(tag))
+                    if keys:
+                        removed += redis_service.client.delete(*[self._redis_key(key) for key in keys])
+                    redis_service.client.delete(self._redis_tag_key(tag))
+            except Exception as e:
+                logger.warning(f"删除Redis LLM缓存失败: {e}")
+        logger.info(f"已按标签 {list(tags)} 失效 {removed} 条LLM缓存")
+        return removed
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats.update({"redis_enabled": self.redis_enabled, "redis_hits": self.redis_hits, "redis_misses": self.redis_misses})
+        return stats
+
+    def _redis_key(self, key: str) -> str:
+        return f"{Config.LLM_CACHE_REDIS_PREFIX}:{key}"
+
+    def _redis_tag_key(self, tag: str) -> str:
+        return f"{Config.LLM_CACHE_REDIS_PREFIX}:tag:{tag}"
+
+
+llm_response_cache = LLMResponseCache(
+    max_entries=Config.LLM_CACHE_MAX_ENTRIES,
+    max_bytes=Config.LLM_CACHE_MAX_MB * 1024 * 1024,
+    ttl=Config.LLM_CACHE_TTL,
+    redis_enabled=Config.LLM_CACHE_REDIS_ENABLED
+)
@@ -1,10 +1,29 @@
 from service.config import Config
+import json
 import asyncio
 from utils.logger import logger
-import requests
+import httpx
+from typing import AsyncIterator, List
+from service.llm_cache import llm_response_cache
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class LLMServiceError(Exception):
+    pass
+
 
 class LLM_Service:
+    # 所有实例共享的连接池客户端及全局在途请求上限
+    _client = None
+    _global_semaphore = None
+
     def __init__(self, config: Config):
+        self.config = config
         self.api_key = config.API_KEY
         self.base_url = config.LLM_BASE_URL
         self.model = config.LLM_MODEL
@@ -31,13 +50,42 @@ class LLM_Service:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        # 单个请求（每次对话创建一个实例）内的在途LLM调用上限
+        self.request_semaphore = asyncio.Semaphore(config.LLM_MAX_CONCURRENCY_PER_REQUEST)
+
+    @classmethod
+    def get_client(cls, config: Config) -> httpx.AsyncClient:
+        if cls._client is None:
+            cls._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(config.LLM_READ_TIMEOUT, connect=config.LLM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=config.LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.LLM_MAX_CONNECTIONS,
+                    keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY
+                )
+            )
+            logger.info(f"LLM HTTP客户端已创建，HTTP/2: {HTTP2_AVAILABLE}")
+        return cls._client
+
+    @classmethod
+    def get_global_semaphore(cls, config: Config) -> asyncio.Semaphore:
+        if cls._global_semaphore is None:
+            cls._global_semaphore = asyncio.Semaphore(config.LLM_MAX_CONCURRENCY)
+        return cls._global_semaphore
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
 
     
-    def build_llm_request(self, messages, temperature=0.7, extra_body=None) -> dict:
+    def build_llm_request(self, messages, temperature=0.7, extra_body=None, stream=None) -> dict:
         payload = {
             "model": self.model,
             "messages": messages,
-            "stream": self.stream,
+            "stream": self.stream if stream is None else stream,
             "max_tokens": self.max_tokens,
             "stop": None,
             "temperature": temperature,
@@ -53,25 +101,101 @@ class LLM_Service:
         return payload, headers
 
 
-    def chat_completion(self, payload: dict, headers: dict) -> str:
+    async def request_chat_completion(self, payload: dict, headers: dict) -> str:
+        '''
+        通过共享连接池发起请求，失败时抛出LLMServiceError
+        '''
+        client = self.get_client(self.config)
+        async with self.get_global_semaphore(self.config), self.request_semaphore:
+            try:
+                response = await client.post(self.base_url, json=payload, headers=headers)
+            except httpx.HTTPError as e:
+                logger.error(f"LLM 请求失败: {e}")
+                raise LLMServiceError(f"调用模型时出错: {str(e)}") from e
+
+        # 检查响应
+        if response.status_code != 200:
+            raise LLMServiceError(f"API调用失败: HTTP {response.status_code}, {response.text}")
         try:
-            response = requests.post(self.base_url, json=payload, headers=headers)
-            # 检查响应
-            if response.status_code == 200:
-                result = response.json()
-                # 提取回复内容
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
-                else:
-                   return f"API调用失败: HTTP {response.status_code}, {response.text}"
-            else:
-                return f"API调用失败: HTTP {response.status_code}, {response.text}"
-
-        except Exception as e:
-            logger.error(f"LLM 请求失败: {e}")
-            return f"调用模型时出错: {str(e)}" 
-    
+            result = response.json()
+        except ValueError as e:
+            raise LLMServiceError(f"调用模型时出错: {str(e)}") from e
+        # 提取回复内容
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0]["message"]["content"]
+        raise LLMServiceError(f"API调用失败: HTTP {response.status_code}, {response.text}")
 
-    async def async_chat_completion(self, messages: list, temperature=0.7, extra_body=None) -> str:
+    async def async_chat_completion(self, messages: list, temperature=0.7, extra_body=None, cache=False, cache_tags: List[str] = (), raise_on_error=False) -> str:
+        '''
+        cache为True时按模型、消息与采样参数缓存结果（仅缓存成功的响应），cache_tags用于按文档失效。
+        默认失败时返回错误信息文本，raise_on_error为True时抛出LLMServiceError
+        '''
         payload, headers = self.build_llm_request(messages, temperature, extra_body)
-        return await asyncio.to_thread(self.chat_completion, payload=payload, headers=headers)
+        cache_key = llm_response_cache.make_key(payload, extra_body) if cache else None
+        if cache:
+            cached = await self.get_cached(cache_key)
+            if cached is not None:
+                return cached
+        try:
+            content = await self.request_chat_completion(payload, headers)
+        except LLMServiceError as e:
+            if raise_on_error:
+                raise
+            return str(e)
+        if cache:
+            await self.put_cached(cache_key, content, cache_tags)
+        return content
+
+    async def async_stream_chat_completion(self, messages: list, temperature=0.7, extra_body=None, cache=False, cache_tags: List[str] = ()) -> AsyncIterator[str]:
+        '''
+        以SSE流式请求上游LLM，逐段产出生成的文本，失败时抛出LLMServiceError。
+        cache为True时命中缓存则一次性产出完整结果，未命中时只有完整读完的流才会写入缓存
+        '''
+        payload, headers = self.build_llm_request(messages, temperature, extra_body, stream=True)
+        cache_key = llm_response_cache.make_key(payload, extra_body) if cache else None
+        if cache:
+            cached = await self.get_cached(cache_key)
+            if cached is not None:
+                yield cached
+                return
+
+        content_parts = []
+        client = self.get_client(self.config)
+        async with self.get_global_semaphore(self.config), self.request_semaphore:
+            try:
+                async with client.stream("POST", self.base_url, json=payload, headers=headers) as response:
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise LLMServiceError(f"API调用失败: HTTP {response.status_code}, {body.decode(errors='ignore')}")
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            chunk = json.loads(data)
+                        except ValueError:
+                            logger.warning(f"无法解析的流式数据: {data}")
+                            continue
+                        choices = chunk.get("choices") or []
+                        content = choices[0].get("delta", {}).get("content") if choices else None
+                        if content:
+                            content_parts.append(content)
+                            yield content
+            except httpx.HTTPError as e:
+                logger.error(f"LLM 流式请求失败: {e}")
+                raise LLMServiceError(f"调用模型时出错: {str(e)}") from e
+        if cache and content_parts:
+            await self.put_cached(cache_key, "".join(content_parts), cache_tags)
+
+    async def get_cached(self, cache_key: str):
+        if llm_response_cache.redis_enabled:
+            return await asyncio.to_thread(llm_response_cache.get, cache_key)
+        return llm_response_cache.get(cache_key)
+
+    async def put_cached(self, cache_key: str, content: str, cache_tags: List[str] = ()):
+        if llm_response_cache.redis_enabled:
+            await asyncio.to_thread(llm_response_cache.put, cache_key, content, cache_tags)
+        else:
+            llm_response_cache.put(cache_key, content, cache_tags)
@@ -1,39 +1,110 @@
 # -*- coding: utf-8 -*-
 
+import time
+import asyncio
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from pymilvus import MilvusClient, MilvusException, DataType, AnnSearchRequest, RRFRanker, Function, FunctionType
+from pymilvus import MilvusClient, AsyncMilvusClient, MilvusException, DataType, AnnSearchRequest, RRFRanker, Function, FunctionType
 from pymilvus.model.hybrid import BGEM3EmbeddingFunction
 from pymilvus.model.reranker import BGERerankFunction
 from utils.logger import logger
 from service.config import Config
 from service.redis_service import redis_service
+from service.collection_manager import CollectionManager
+from service.embedding_batcher import EmbeddingBatcher
+from service.embedding_cache import QueryEmbeddingCache
+from service.embedding_store import ChunkEmbeddingStore
+from service.rerank_cache import RerankScoreCache
 
 
 class M3EEmbeddings():
     def __init__(self):
+        # 稀疏向量由Milvus的BM25函数生成，模型只需输出稠密向量
         self.embedding_function = BGEM3EmbeddingFunction(
             model_name=Config.EMBEDDING_MODEL,
             use_fp16=False,
-            device='cpu'
+            device='cpu',
+            return_sparse=False
+        )
+        # 查询向量化的跨请求微批调度
+        self.query_batcher = EmbeddingBatcher(
+            self.embedding_function.encode_queries,
+            max_batch_size=Config.EMBEDDING_BATCH_SIZE,
+            max_wait_ms=Config.EMBEDDING_BATCH_WAIT_MS
+        )
+        # 查询向量缓存，重复或仅有空白/大小写/标点差异的问题直接复用向量
+        self.query_cache = QueryEmbeddingCache(
+            model_id=Config.EMBEDDING_MODEL,
+            max_entries=Config.EMBEDDING_CACHE_MAX_ENTRIES,
+            max_bytes=Config.EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+            redis_enabled=Config.EMBEDDING_CACHE_REDIS_ENABLED,
+            redis_ttl=Config.EMBEDDING_CACHE_REDIS_TTL
         )
 
     def encode_documents(self, content: List[str]) -> List[float]:
         return self.embedding_function.encode_documents(content)
     
-    def encode_query(self, content: List[str]) -> List[float]:
-        return self.embedding_function.encode_queries(content)
+    async def async_encode_query(self, content: List[str]):
+        vectors = self.query_cache.get_local(content)
+        if self.query_cache.redis_enabled and None in vectors:
+            # Redis为同步IO，放到线程中执行
+            vectors = await asyncio.to_thread(self._fill_misses, content, vectors, self.query_cache.get_remote)
+        miss_indexes = [i for i, vector in enumerate(vectors) if vector is None]
+        futures = self.query_batcher.submit_many([content[i] for i in miss_indexes])
+        encoded = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        if self.query_cache.redis_enabled:
+            await asyncio.to_thread(self.query_cache.put_many, [content[i] for i in miss_indexes], encoded)
+        else:
+            self.query_cache.put_many([content[i] for i in miss_indexes], encoded)
+        return {"dense": self._merge_encoded(vectors, miss_indexes, encoded)}
+
+    def _fill_misses(self, content, vectors, lookup):
+        miss_indexes = [i for i, vector in enumerate(vectors) if vector is None]
+        if not miss_indexes:
+            return vectors
+        vectors = list(vectors)
+        for i, vector in zip(miss_indexes, lookup([content[i] for i in miss_indexes])):
+            vectors[i] = vector
+        return vectors
+
+    def _merge_encoded(self, vectors, miss_indexes, encoded):
+        vectors = list(vectors)
+        for i, vector in zip(miss_indexes, encoded):
+            vectors[i] = vector
+        return vectors
     
     
 class MilvusService:
     def __init__(self):
         if not self.connect_to_milvus():
             raise ConnectionError("Failed to connect to Milvus")
+        # 集合加载生命周期管理，集合常驻内存
+        self.collection_manager = CollectionManager(self.client)
         # 嵌入模型
         self.embedding_model = M3EEmbeddings()  
+        # 切片向量持久化存储，重复入库的切片无需重新向量化
+        self.embedding_store = (
+            ChunkEmbeddingStore(Config.EMBEDDING_STORE_DIR, model_id=Config.EMBEDDING_MODEL, dimension=Config.EMBEDDING_DIMENSION)
+            if Config.EMBEDDING_STORE_ENABLED else None
+        )
         # 重排序模型
         self.reranker = (
             BGERerankFunction(model_name=Config.RERANKING_MODEL, device='cpu')
         )
+        # 重排序分数缓存
+        self.rerank_cache = RerankScoreCache(
+            max_entries=Config.RERANK_CACHE_MAX_ENTRIES,
+            max_bytes=Config.RERANK_CACHE_MAX_MB * 1024 * 1024
+        )
+        # CPU推理专用的有界线程池，模型推理不阻塞事件循环，也不占用默认线程池
+        self.inference_executor = ThreadPoolExecutor(
+            max_workers=Config.INFERENCE_WORKERS,
+            thread_name_prefix="inference"
+        )
+        # 异步客户端需在事件循环内创建，首次使用时初始化
+        self.async_client = None
 
     def connect_to_milvus(self):
         try:
@@ -45,6 +116,50 @@ class MilvusService:
         except MilvusException as e:
             logger.error(f"Failed to connect to Milvus: {e}")
             return False
+
+    def get_async_client(self) -> AsyncMilvusClient:
+        if self.async_client is None:
+            self.async_client = AsyncMilvusClient(uri=Config.MILVUS_SERVER, user=Config.MILVUS_USER,
+            password=Config.MILVUS_PASSWORD)
+        return self.async_client
+
+    async def close(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+        self.inference_executor.shutdown(wait=False)
+
+    async def run_in_inference_executor(self, func, *args, **kwargs):
+        '''
+        在推理线程池中执行CPU密集的模型调用
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.inference_executor, functools.partial(func, *args, **kwargs))
+
+    async def async_encode_query(self, content: List[str]):
+        # 查询向量化经由微批调度器，无需占用推理线程池
+        return await self.embedding_model.async_encode_query(content)
+
+    async def async_rerank(self, query: str, documents: List[str], top_k: int = 5):
+        return await self.run_in_inference_executor(self.reranker, query, documents, top_k=top_k)
+
+    async def async_rerank_chunks(self, query: str, chunk_ids: List[str], documents: List[str]) -> List[float]:
+        '''
+        返回与chunk_ids顺序一致的重排序分数，只有缓存未命中的切片才送入重排序模型
+        '''
+        corpus_version = await asyncio.to_thread(redis_service.get_corpus_version)
+        scores = self.rerank_cache.get_many(query, chunk_ids, corpus_version)
+        miss_indexes = [i for i, score in enumerate(scores) if score is None]
+        if not miss_indexes:
+            return scores
+
+        start_time = time.perf_counter()
+        results = await self.async_rerank(query, [documents[i] for i in miss_indexes], top_k=len(miss_indexes))
+        self.rerank_cache.record_model_time(len(miss_indexes), time.perf_counter() - start_time)
+        for hit in results:
+            scores[miss_indexes[hit.index]] = hit.score
+        self.rerank_cache.put_many(query, [chunk_ids[i] for i in miss_indexes], [scores[i] for i in miss_indexes], corpus_version)
+        return scores
         
     def get_collection_names(self):
         return self.client.list_collections()
@@ -71,7 +186,7 @@ class MilvusService:
         schema.add_field(field_name="chunk_id", datatype=DataType.VARCHAR, is_primary=True, max_length=256)
         schema.add_field(field_name="document_id", datatype=DataType.VARCHAR, max_length=256)
         schema.add_field(field_name="document_name", datatype=DataType.VARCHAR, max_length=256)
-        schema.add_field(field_name="chunk_text", datatype=DataType.VARCHAR, max_length=4096, enable_analyzer=True)
+        schema.add_field(field_name="chunk_text", datatype=DataType.VARCHAR, max_length=Config.CHUNK_MAX_BYTES, enable_analyzer=True)
         schema.add_field(field_name="dense_embedding", datatype=DataType.FLOAT_VECTOR, dim=dimension)
         schema.add_field(field_name="sparse_embedding", datatype=DataType.SPARSE_FLOAT_VECTOR)
 
@@ -90,6 +205,7 @@ class MilvusService:
             schema=schema
         )
         self.create_index(collection_name)
+        self.collection_manager.ensure_loaded(collection_name)
 
     def create_index(self, collection_name):
         try:
@@ -123,73 +239,139 @@ class MilvusService:
             return False
         
 
-    def add_documents(self, chunks, collection_name, **kwargs):
+    def encode_chunks(self, chunks: List[str]) -> List:
+        # 相同文本只编码一次，批量入库时不同文件间的重复切片共享向量
+        unique_chunks = list(dict.fromkeys(chunks))
+        if self.embedding_store is None:
+            unique_vectors = self.embedding_model.encode_documents(unique_chunks)['dense']
+        else:
+            unique_vectors = self.embedding_store.encode_with_store(unique_chunks, lambda texts: self.embedding_model.encode_documents(texts)['dense'])
+        if len(unique_chunks) == len(chunks):
+            return unique_vectors
+        vector_map = dict(zip(unique_chunks, unique_vectors))
+        return [vector_map[chunk] for chunk in chunks]
+
+    def make_chunk_id(self, document_uuid, chunk_text: str) -> str:
+        # 切片ID由文档ID与内容哈希组成，文档新版本中未变化的切片ID保持不变
+        return f"{document_uuid}_{hashlib.sha256(chunk_text.encode('utf-8')).hexdigest()[:32]}"
+
+    def add_chunk_batches(self, chunk_batches, collection_name, progress_callback=None, existing_chunk_ids=None, written_chunk_ids=None, **kwargs):
+        '''
+        逐批向量化并写入切片，chunk_batches可为生成器，边产出边入库；切片ID由内容哈希生成，文档内重复的切片只写入一次。
+        existing_chunk_ids中已存在的切片跳过（文档更新时只写入新增切片），返回写入数量及本次全部切片ID。
+        written_chunk_ids为调用方传入的集合，每批写入前记录该批切片ID，写入中途失败时调用方据此回滚，无需重新查询Milvus。
+        每批完成后调用progress_callback(stage, count)，stage为'embedded'、'inserted'或'unchanged'；回调抛出的异常会中止后续批次
+        '''
         if not self.client.has_collection(collection_name=collection_name):
             logger.error(f"Collection {collection_name} not found, create it")
             self.create_collection(collection_name)
 
-        # 生成文本的向量嵌入
-        vectors = self.embedding_model.encode_documents(chunks)
+        existing_chunk_ids = existing_chunk_ids or set()
+        chunk_ids = set()
+        insert_count = 0
+        for batch in chunk_batches:
+            rows = []
+            unchanged = 0
+            for chunk in batch:
+                chunk_id = self.make_chunk_id(kwargs['document_uuid'], chunk)
+                if chunk_id in chunk_ids:
+                    continue
+                chunk_ids.add(chunk_id)
+                if chunk_id in existing_chunk_ids:
+                    unchanged += 1
+                    continue
+                rows.append({
+                    "chunk_id": chunk_id,
+                    "document_id": str(kwargs['document_uuid']),  # 保存原始文档ID
+                    "document_name": str(kwargs['document_name']),
+                    "chunk_text": chunk,
+                })
+            if unchanged and progress_callback is not None:
+                progress_callback("unchanged", unchanged)
+            if rows:
+                if written_chunk_ids is not None:
+                    written_chunk_ids.update(row["chunk_id"] for row in rows)
+                insert_count += self.insert_chunk_rows(rows, collection_name, progress_callback)
+
+        logger.info(f"成功向{collection_name}插入{insert_count}条记录")
+        return {"insert_count": insert_count, "chunk_ids": chunk_ids}
+
+    def list_chunk_ids(self, collection_name, document_uuid) -> set:
+        '''
+        返回文档在Milvus中已有的全部切片ID，使用强一致性读取，刚写入的切片也能查到
+        '''
+        chunk_ids = set()
+        with self.collection_manager.acquire(collection_name):
+            iterator = self.client.query_iterator(
+                collection_name=collection_name,
+                batch_size=Config.INGESTION_BATCH_SIZE * 16,
+                filter=f"document_id == '{document_uuid}'",
+                output_fields=["chunk_id"],
+                consistency_level="Strong"
+            )
+            try:
+                while rows := iterator.next():
+                    chunk_ids.update(row["chunk_id"] for row in rows)
+            finally:
+                iterator.close()
+        return chunk_ids
+
+    def delete_chunks(self, collection_name, chunk_ids) -> int:
+        '''
+        按切片ID分批删除，返回删除数量
+        '''
+        chunk_ids = list(chunk_ids)
+        batch_size = Config.INGESTION_BATCH_SIZE * 16
+        with self.collection_manager.acquire(collection_name):
+            for start in range(0, len(chunk_ids), batch_size):
+                self.client.delete(collection_name=collection_name, ids=chunk_ids[start:start + batch_size])
+        if chunk_ids:
+            logger.info(f"已从{collection_name}删除{len(chunk_ids)}个切片")
+        return len(chunk_ids)
+
+    def insert_chunk_rows(self, rows: List[dict], collection_name, progress_callback=None) -> int:
+        '''
+        向量化并写入一批切片行，行可来自不同文档，每行含chunk_id、document_id、document_name、chunk_text。
+        Milvus插入不校验主键唯一，按chunk_id执行upsert，同一内容的切片重复写入时不会产生重复实体
+        '''
+        # 生成文本的向量嵌入，已入库过的切片直接从持久化存储读取
+        vectors = self.encode_chunks([row["chunk_text"] for row in rows])
+        if progress_callback is not None:
+            progress_callback("embedded", len(rows))
 
         # 准备数据
-        data = []
-        for i in range(len(chunks)):
-            # 为每个块生成唯一的ID，避免主键冲突
-            chunk_id = f"{kwargs['document_uuid']}_{i}"
-            data.append({
-                "chunk_id": chunk_id,  # 修改为块级唯一ID
-                "document_id": str(kwargs['document_uuid']),  # 保存原始文档ID
-                "document_name": str(kwargs['document_name']),
-                "chunk_text": chunks[i],
-                "dense_embedding": vectors['dense'][i],
-            })
-        
+        data = [{**row, "dense_embedding": vector} for row, vector in zip(rows, vectors)]
         try:
-            res = self.client.insert(collection_name=collection_name, data=data)
-            logger.info(f"成功向{collection_name}插入{len(data)}条记录")
-            return res
+            res = self.client.upsert(collection_name=collection_name, data=data)
         except Exception as e:
             logger.error(f"插入数据失败: {e}")
             raise
-    
+        if progress_callback is not None:
+            progress_callback("inserted", len(rows))
+        return res.get("upsert_count", len(data))
+
     def delete_documents(self, collection_name, document_uuid):
         try:
             # 检查集合是否存在
             if not self.client.has_collection(collection_name=collection_name, timeout=100000):
                 logger.warning(f"集合 {collection_name} 不存在，无法删除")
                 return {"delete_count": 0}
-                
-            #先加载集合到内存
-            self.client.load_collection(collection_name=collection_name)
-            logger.info("已加载到内存")
-            
-            # 执行删除操作，使用document_id作为过滤条件
-            res = self.client.delete(collection_name=collection_name, filter=f"document_id == '{document_uuid}'")
+
+            # 集合常驻内存，删除期间持有引用，避免被并发释放
+            with self.collection_manager.acquire(collection_name):
+                # 执行删除操作，使用document_id作为过滤条件
+                res = self.client.delete(collection_name=collection_name, filter=f"document_id == '{document_uuid}'")
             logger.info("已从集合中删除文档")
-            
-            # 操作完成后释放集合
-            self.client.release_collection(collection_name=collection_name)
-            logger.info("集合已从内存释放")
-            
+
             return res
         except Exception as e:
             logger.error(f"删除文档失败: {e}")
-            # 确保发生错误时也释放集合
-            try:
-                self.client.release_collection(collection_name=collection_name)
-            except:
-                pass
             raise
 
-    def search_by_vector(self, query, query_vector, collection_name, limit=5):
-        # 查询禁用的文档id
-        disabled_document_ids = redis_service.get_disabled_document()
-        #先加载集合到内存
-        self.client.load_collection(collection_name=collection_name)
-
-        # 准备混合搜索参数
+    def build_hybrid_search_requests(self, queries: List[str], query_vectors, limit=5):
+        # 准备混合搜索参数，queries与query_vectors['dense']一一对应，nq=len(queries)
         dense_search_params = {
-            "data": query_vector['dense'],
+            "data": list(query_vectors['dense']),
             "anns_field": "dense_embedding",
             "param": {
                 "metric_type": "COSINE",
@@ -197,7 +379,7 @@ class MilvusService:
             "limit": limit
         }
         sparse_search_params = {
-            "data": [query],
+            "data": list(queries),
             "anns_field": "sparse_embedding",
             "param": {
                 "metric_type": "BM25",
@@ -207,18 +389,33 @@ class MilvusService:
         }
         dense_search_req = AnnSearchRequest(**dense_search_params)
         sparse_search_req = AnnSearchRequest(**sparse_search_params)
+        return [dense_search_req, sparse_search_req]
+
+    async def async_search_by_vectors(self, queries: List[str], query_vectors, collection_name, limit=5):
+        '''
+        一次hybrid_search完成多个问题的检索，返回与queries顺序一致的命中列表
+        '''
+        if not queries:
+            return []
+        # Redis查询为同步IO，放到线程中执行
+        disabled_document_ids = await asyncio.to_thread(redis_service.get_disabled_document)
+        async_client = self.get_async_client()
 
         ranker = RRFRanker()
-        res = self.client.hybrid_search(
-            collection_name=collection_name,
-            reqs=[dense_search_req, sparse_search_req],
-            ranker=ranker,
-            limit=limit,
-            filter=f"document_id not in '{disabled_document_ids}'",
-            output_fields=["document_id", "chunk_text", "document_name"],
-        )
-        self.client.release_collection(collection_name=collection_name)
-        return res[0]
-    
+        async with self.collection_manager.async_acquire(collection_name):
+            try:
+                res = await async_client.hybrid_search(
+                    collection_name=collection_name,
+                    reqs=self.build_hybrid_search_requests(queries, query_vectors, limit),
+                    ranker=ranker,
+                    limit=limit,
+                    filter=f"document_id not in '{disabled_document_ids}'",
+                    output_fields=["document_id", "chunk_text", "document_name"],
+                )
+            except MilvusException:
+                # 集合可能已在Milvus侧被释放，下次请求重新加载
+                self.collection_manager.mark_unloaded(collection_name)
+                raise
+        return [list(hits) for hits in res]
 
 milvus_service = MilvusService()
\ No newline at end of file
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+
+import numpy as np
+
+from service.config import Config
+from service.milvus_service import milvus_service, MilvusService
+from service.redis_service import redis_service
+from utils.logger import logger
+
+
+class QueryRouter:
+    '''
+    基于BGE-M3查询向量的本地问题路由，判断问题是否需要走重写、检索与相关性判断流程。
+    若配置了线性分类头则直接使用；否则比较问题与知识库质心、闲聊原型之间的相似度，只有明显属于闲聊的问题才跳过检索。
+    '''
+    CHITCHAT_PROMPTS = [
+        "你好", "您好", "在吗", "谢谢", "谢谢你的帮助", "再见", "你是谁", "你叫什么名字", "早上好", "晚安",
+        "哈哈", "好的", "今天天气怎么样", "讲个笑话", "hello", "hi", "thanks", "bye",
+    ]
+
+    def __init__(self, milvus_service: MilvusService):
+        self.milvus_service = milvus_service
+        self.chitchat_vectors = None
+        self.corpus_centroids = None
+        self.centroids_version = None
+        self._refresh_task = None
+        self.head = self.load_head(Config.ROUTER_HEAD_PATH)
+
+    def load_head(self, head_path):
+        '''
+        加载线性分类头，npz文件包含weight（维度与嵌入向量一致）和bias，输出为需要检索的logit
+        '''
+        if not head_path or not os.path.exists(head_path):
+            return None
+        head = np.load(head_path)
+        logger.info(f"已加载问题路由线性分类头: {head_path}")
+        return head["weight"].astype(np.float32), float(head["bias"])
+
+    async def should_retrieve(self, query: str) -> bool:
+        # 查询向量与后续检索共用缓存，不额外增加模型调用
+        vector = np.asarray((await self.milvus_service.async_encode_query([query]))['dense'][0], dtype=np.float32)
+        if self.head is not None:
+            weight, bias = self.head
+            return float(vector @ weight + bias) >= 0
+
+        corpus_version = await asyncio.to_thread(redis_service.get_corpus_version)
+        if corpus_version != self.centroids_version:
+            # 知识库变化后在后台重新计算质心，期间继续使用旧质心；首次计算完成前一律检索
+            self.schedule_refresh(corpus_version)
+        if self.corpus_centroids is None:
+            return True
+        if self.chitchat_vectors is None:
+            encoded = await self.milvus_service.async_encode_query(self.CHITCHAT_PROMPTS)
+            self.chitchat_vectors = np.asarray(encoded['dense'], dtype=np.float32)
+
+        corpus_similarity = float(np.max(self.corpus_centroids @ vector))
+        chitchat_similarity = float(np.max(self.chitchat_vectors @ vector))
+        logger.info(f"问题路由: 知识库相似度 {corpus_similarity:.4f}, 闲聊相似度 {chitchat_similarity:.4f}")
+        return (corpus_similarity >= Config.ROUTER_CORPUS_THRESHOLD
+                or chitchat_similarity - corpus_similarity < Config.ROUTER_MARGIN)
+
+    def schedule_refresh(self, corpus_version):
+        # 同一时间只运行一个后台计算任务，结束后若版本又有变化，下次路由时再次触发
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh_centroids(corpus_version))
+
+    async def refresh_centroids(self, corpus_version):
+        '''
+        重新采样切片向量并计算质心，记录对应的知识库版本
+        '''
+        try:
+            centroids = await asyncio.to_thread(self.compute_centroids)
+        except Exception as e:
+            logger.error(f"计算知识库质心失败: {e}")
+            return
+        self.corpus_centroids = centroids
+        self.centroids_version = corpus_version
+
+    def compute_centroids(self):
+        collection_name = Config.MILVUS_COLLECTION_NAME
+        if not self.milvus_service.client.has_collection(collection_name=collection_name):
+            return None
+        with self.milvus_service.collection_manager.acquire(collection_name):
+            rows = self.milvus_service.client.query(
+                collection_name=collection_name,
+                filter="",
+                output_fields=["dense_embedding"],
+                limit=Config.ROUTER_SAMPLE_SIZE
+            )
+        if not rows:
+            return None
+        vectors = np.asarray([row["dense_embedding"] for row in rows], dtype=np.float32)
+        centroids = self.spherical_kmeans(vectors, min(Config.ROUTER_CENTROIDS, len(vectors)))
+        logger.info(f"已根据 {len(vectors)} 个切片向量计算 {len(centroids)} 个知识库质心")
+        return centroids
+
+    def spherical_kmeans(self, vectors, k, iterations=20):
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(len(vectors), size=k, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(k):
+                members = vectors[assignments == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True).clip(min=1e-12)
+        return centroids
+
+
+query_router = QueryRouter(milvus_service)
@@ -1,19 +1,34 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional
+import re
 import json
 import time
 import asyncio
 import uuid
+from contextlib import aclosing
 
 from service.document_service import DocumentService
 from service.conversation_service import ConversationService
 from sqlalchemy.orm import Session
-from service.llm_service import LLM_Service
+from service.llm_service import LLM_Service, LLMServiceError
+from service.query_router import query_router
+from service.answer_cache import answer_cache
+from service.redis_service import redis_service
 from utils.prompts import build_rewrite_prompt
 from utils.logger import logger
+from utils.calibration import calibrate_score
+from utils.cache_util import normalize_query
+from utils.singleflight import SingleFlight
 from service.config import Config
 import utils.prompts as prompts
 
 
+# 从流式输出中匹配完整的 "question": "..." 字段
+REWRITE_QUESTION_PATTERN = re.compile(r'"question"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# 跨请求共享的请求合并器
+request_coalescer = SingleFlight()
+
+
 class RAGService:
     def __init__(self, db: Session):
         self.document_service = DocumentService(db)
@@ -23,136 +38,328 @@ class RAGService:
     async def non_streaming_workflow(self, conversation_id: str, user_query: str) -> Dict[str, Any]:
         request_id = str(uuid.uuid4())
 
-        # Step 1: 获取该对话的所有历史消息和最后一条消息
+        # Step 1: 获取该对话的所有历史消息
+        history_messages = self.get_history_messages(conversation_id)
+
+        # 首轮问题先查询语义答案缓存
+        cache_key, cached_result = await self.lookup_answer_cache(user_query, history_messages)
+        if cached_result is not None:
+            return cached_result
+
+        # 相同的首轮问题并发到达时合并为一次检索与生成
+        coalesce_key = await self.get_coalesce_key(user_query, history_messages)
+        if coalesce_key is None:
+            return await self.generate_answer(request_id, history_messages, user_query, cache_key)
+        result = await request_coalescer.do(
+            ('answer', *coalesce_key),
+            lambda: self.generate_answer(request_id, history_messages, user_query, cache_key)
+        )
+        return dict(result)
+
+    async def generate_answer(self, request_id: str, history_messages, user_query: str, cache_key) -> Dict[str, Any]:
+        # Step 2-5: 重写扩展、检索与相关性分析
+        context = await self.retrieve_context(history_messages, user_query)
+        hit_chunks = context['hit_chunks']
+        if context['degraded']:
+            # 重写或相关性判断失败时答案不可靠，不写入答案缓存
+            cache_key = None
+
+        # Step 6: 调用大模型
+        try:
+            instruction, response = await self.decorate_answer(request_id, self.llm_service, hit_chunks, context['history'], raise_on_error=True)
+        except LLMServiceError as e:
+            instruction, response, cache_key = self.build_answer_instruction(hit_chunks), str(e), None
+        
+        logger.info(f'LLM response: {response}')
+        result = {
+            'prompt': instruction,
+            'response': response,
+            'documents_count': len(hit_chunks),
+            'documents_names': context['references']
+        } 
+        self.store_answer_cache(cache_key, result)
+        return result
+
+    async def streaming_workflow(self, conversation_id: str, user_query: str) -> AsyncIterator[Dict[str, Any]]:
+        '''
+        流式工作流：先产出检索元数据事件，再逐个产出大模型生成的token事件
+        '''
+        history_messages = self.get_history_messages(conversation_id)
+
+        # 首轮问题命中语义答案缓存时一次性产出完整答案
+        cache_key, cached_result = await self.lookup_answer_cache(user_query, history_messages)
+        if cached_result is not None:
+            yield {
+                'event': 'metadata',
+                'data': {
+                    'prompt': cached_result['prompt'],
+                    'documents_count': cached_result['documents_count'],
+                    'documents_names': cached_result['documents_names']
+                }
+            }
+            yield {'event': 'token', 'data': {'content': cached_result['response']}}
+            return
+
+        # 流式生成无法共享，仅合并相同首轮问题的检索阶段
+        coalesce_key = await self.get_coalesce_key(user_query, history_messages)
+        if coalesce_key is None:
+            context = await self.retrieve_context(history_messages, user_query)
+        else:
+            context = await request_coalescer.do(
+                ('retrieve', *coalesce_key),
+                lambda: self.retrieve_context(history_messages, user_query)
+            )
+        hit_chunks = context['hit_chunks']
+        if context['degraded']:
+            cache_key = None
+        instruction = self.build_answer_instruction(hit_chunks)
+        yield {
+            'event': 'metadata',
+            'data': {
+                'prompt': instruction,
+                'documents_count': len(hit_chunks),
+                'documents_names': context['references']
+            }
+        }
+
+        response_parts = []
+        async for token in self.llm_service.async_stream_chat_completion(
+            [{"role": "system", "content": instruction}, *context['history']],
+        ):
+            response_parts.append(token)
+            yield {'event': 'token', 'data': {'content': token}}
+
+        self.store_answer_cache(cache_key, {
+            'prompt': instruction,
+            'response': "".join(response_parts),
+            'documents_count': len(hit_chunks),
+            'documents_names': context['references']
+        })
+
+    def get_history_messages(self, conversation_id: str):
         history_messages = self.conversation_service.get_conversation_messages(conversation_id)
+        logger.info("获取历史消息完成...")
+        return history_messages
+
+    async def lookup_answer_cache(self, user_query: str, history_messages) -> tuple:
+        '''
+        首轮问题查询语义答案缓存，返回(缓存键, 命中结果)；未开启或非首轮问题时返回(None, None)
+        '''
+        if not Config.ANSWER_CACHE_ENABLED or len(history_messages) != 1:
+            return None, None
+        query_vectors = await self.document_service.milvus_service.async_encode_query([user_query])
+        corpus_version = await asyncio.to_thread(redis_service.get_corpus_version)
+        cache_key = (query_vectors['dense'][0], corpus_version)
+        return cache_key, answer_cache.lookup(*cache_key)
+
+    async def get_coalesce_key(self, user_query: str, history_messages) -> Optional[tuple]:
+        '''
+        首轮问题的请求合并键：(归一化问题, 知识库版本号)；未开启或非首轮问题时返回None
+        '''
+        if not Config.REQUEST_COALESCING_ENABLED or len(history_messages) != 1:
+            return None
+        corpus_version = await asyncio.to_thread(redis_service.get_corpus_version)
+        return (normalize_query(user_query), corpus_version)
+
+    def store_answer_cache(self, cache_key, result: Dict[str, Any]):
+        if cache_key is None or not result['response']:
+            return
+        vector, corpus_version = cache_key
+        # 以查询时的知识库版本写入，期间知识库若有变化则不会写入
+        answer_cache.put(vector, result, corpus_version)
+
+    async def retrieve_context(self, history_messages, user_query: str) -> Dict[str, Any]:
         last_message_content = history_messages[-1].content
         formatted_history_messages = [{"role": message.role, "content": message.content} for message in history_messages]
-        logger.info("获取历史消息完成...")
 
-        # Step 2: 对原问题进行重新扩展
-        expanded_questions = await self.rewrite_question(self.llm_service, user_query, Config.QUESTION_REWRITE_NUM)
-        if len(history_messages) > 0:
-            expanded_questions.append(last_message_content)
-        logger.info("重写扩展完成...")
-        logger.info(f"重写扩展后的问题: {expanded_questions}")
-            
-        # Step 4: 检索知识库
+        # 本地路由：闲聊、问候等问题直接回答，跳过重写、检索与相关性判断
+        if Config.QUESTION_RETRIEVE_ENABLED and not await query_router.should_retrieve(user_query):
+            logger.info("问题路由判断无需检索知识库，直接回答")
+            return {
+                'history': formatted_history_messages,
+                'hit_chunks': [],
+                'references': [],
+                'degraded': False
+            }
+
+        # Step 2 & 4: 原问题与最后一条消息立即开始检索，同时并发生成重写问题，每解析出一个重写问题就立即检索
         logger.info("开始检索知识库...")
-        search_tasks = [self.document_service.retrieve(question, Config.RETRIEVE_TOPK) for question in expanded_questions]
-        task_results = await asyncio.gather(*search_tasks)
-        logger.info(f"检索知识库结果: {task_results}")
-        retrieved_chunks = []
-        for (chunks, references) in task_results:
-            retrieved_chunks.extend(chunks)
-        # 去重
-        retrieved_chunks = self.deduplicate_chunks(retrieved_chunks) 
+        base_questions = list(dict.fromkeys([user_query, last_message_content]))
+        search_tasks = [asyncio.create_task(self.document_service.search_candidates(base_questions, Config.RETRIEVE_TOPK))]
+        # 重写或相关性判断的LLM调用失败时标记为降级，调用方据此跳过答案缓存
+        degraded = False
+        if Config.QUESTION_REWRITE_ENABLED:
+            expanded_questions = []
+
+            async def search_rewrites():
+                async for question in self.stream_rewrite_questions(self.llm_service, user_query, Config.QUESTION_REWRITE_NUM):
+                    expanded_questions.append(question)
+                    search_tasks.append(asyncio.create_task(self.document_service.search_candidates([question], Config.RETRIEVE_TOPK)))
+
+            try:
+                await asyncio.wait_for(search_rewrites(), timeout=Config.QUESTION_REWRITE_DEADLINE)
+            except asyncio.TimeoutError:
+                logger.warning(f"重写扩展超过 {Config.QUESTION_REWRITE_DEADLINE} 秒，使用已生成的 {len(expanded_questions)} 个重写问题继续")
+            logger.info(f"重写扩展后的问题: {expanded_questions}")
+            degraded = not expanded_questions
+
+        candidate_lists = []
+        for task_result in await asyncio.gather(*search_tasks):
+            candidate_lists.extend(task_result)
+        # 候选并集针对原问题一次重排序
+        retrieved_chunks, _ = await self.document_service.rerank_candidates(
+            user_query, self.document_service.merge_candidates(candidate_lists)
+        )
         logger.info(f'检索出的文档切片: {retrieved_chunks}, 数量: {len(retrieved_chunks)}')
         logger.info("开始数据相关性分析...")
 
         # Step 5: 数据相关性分析
-        tasks = [
-            self.chunk_judge_relevant(self.llm_service, last_message_content, chunk, formatted_history_messages)
-            for chunk in retrieved_chunks
-        ]
-        relevancy_results = await asyncio.gather(*tasks)
+        relevancy_results = await self.judge_relevant(self.llm_service, last_message_content, retrieved_chunks, formatted_history_messages)
+        if any(is_rel is None for is_rel in relevancy_results):
+            logger.warning("部分切片的相关性判断失败，按不相关处理")
+            degraded = True
         hit_chunks = [chunk for chunk, is_rel in zip(retrieved_chunks, relevancy_results) if is_rel][:Config.RETRIEVE_TOPK]
         doc_names = [chunk['doc_name'] for chunk in hit_chunks if chunk['doc_name']]
         references = list(dict.fromkeys(doc_names))
         logger.info(f'相关性判断后的文档切片: {hit_chunks}, 相关文档数量: {len(hit_chunks)}, 相关文档名称: {references}')    
 
-        # Step 6: 调用大模型
-        if 'hit_chunks' in locals() and hit_chunks:
-            instruction, response = await self.decorate_answer(request_id, self.llm_service, hit_chunks, formatted_history_messages)
-        else:
-            instruction, response = await self.decorate_answer(request_id, self.llm_service, [], formatted_history_messages)
-        
-        logger.info(f'LLM response: {response}')
         return {
-            'prompt': instruction,
-            'response': response,
-            'documents_count': len(hit_chunks) if 'hit_chunks' in locals() and hit_chunks else 0,
-            'documents_names': references if 'hit_chunks' in locals() and hit_chunks else []
-        } 
+            'history': formatted_history_messages,
+            'hit_chunks': hit_chunks,
+            'references': references,
+            'degraded': degraded
+        }
     
-    async def rewrite_question(self, llm_service: LLM_Service, original_question: str, question_rewrite_num: int) -> List:
+    async def stream_rewrite_questions(self, llm_service: LLM_Service, original_question: str, question_rewrite_num: int) -> AsyncIterator[str]:
         """
-        使用 LLM 将用户的原始问题进行扩展，返回新的问题列表。
-        根据 question_rewrite_num 生成对应数量的重写问法。
-        如果 JSON 解析失败或内容不符合预期，会进行3次重试，全部重试失败则只返回原问题。
+        流式请求 LLM 重写扩展原问题，每从输出中解析出一个完整的 question 字段就立即产出。
+        若一次尝试未能解析出任何问题，则指数退避后重试，最多3次。
         """
         rewrite_prompt = build_rewrite_prompt(original_question, question_rewrite_num)
         max_retries = 3
         for attempt in range(max_retries):
             logger.info(f"重写问题第{attempt + 1}次尝试重写扩展...")
-            rewrite_response = await llm_service.async_chat_completion([
-                {"role": "system", "content": "你是一个问题扩展助手，可以帮我对原问题进行扩展。"},
-                {"role": "user", "content": rewrite_prompt}
-            ])
-
+            buffer = ""
+            position = 0
+            question_count = 0
             try:
-                expansions = json.loads(rewrite_response)
-                if not isinstance(expansions, list) or len(expansions) == 0:
-                    raise ValueError("解析结果不是有效的列表")
-                
-                questions = [item['question'] for item in expansions if 'question' in item]
-                if len(questions) < question_rewrite_num:
-                    raise ValueError("重写问题数不足。")
-
-                return questions
-            
-            except Exception as e:
-                logger.warning(f"重写扩展解析失败 (第 {attempt} 次): {e}")
-                if attempt < max_retries:
-                    asyncio.sleep(0.02)
-                else:
-                    logger.warning("已达最大重试次数，放弃重写扩展。")
-        
-        return [original_question]
+                # 提前结束时及时关闭上游流式连接
+                async with aclosing(llm_service.async_stream_chat_completion([
+                    {"role": "system", "content": "你是一个问题扩展助手，可以帮我对原问题进行扩展。"},
+                    {"role": "user", "content": rewrite_prompt}
+                ], cache=Config.LLM_CACHE_REWRITE_ENABLED)) as tokens:
+                    async for token in tokens:
+                        buffer += token
+                        for match in REWRITE_QUESTION_PATTERN.finditer(buffer, position):
+                            position = match.end()
+                            question = json.loads(f'"{match.group(1)}"').strip()
+                            # 达到数量后不再产出，但继续读完输出以便写入缓存
+                            if not question or question_count >= question_rewrite_num:
+                                continue
+                            question_count += 1
+                            yield question
+            except (LLMServiceError, ValueError) as e:
+                logger.warning(f"重写扩展失败 (第 {attempt + 1} 次): {e}")
+
+            if question_count > 0:
+                return
+            logger.warning(f"重写扩展解析失败 (第 {attempt + 1} 次): {buffer}")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(0.2 * 2 ** attempt)
+            else:
+                logger.warning("已达最大重试次数，放弃重写扩展。")
     
-    def deduplicate_chunks(self, chunks):
-        """
-        去重切片，切片的text相同则视为是一个，只保留每组中得分最高的切片。
-        """
-        retrieved_chunks_map = {}
+    async def judge_relevant(self, llm_service: LLM_Service, query, chunks, history=[]) -> List[Optional[bool]]:
+        '''
+        按Config.STRATEGY判断切片相关性：
+        'thres'只比较校准后的重排序分数与阈值；'hybrid'只对落在阈值不确定区间内的切片调用LLM；其余使用LLM判断。
+        LLM调用失败的切片结果为None
+        '''
+        if Config.STRATEGY not in ('thres', 'hybrid'):
+            return await self.chunks_judge_relevant(llm_service, query, chunks, history)
 
-        for chunk in chunks:
-            chunk_copy = chunk.copy()
-            score_value = chunk_copy.pop('score', None)
+        scores = [calibrate_score(chunk['score'], Config.SCORE_CALIBRATION_A, Config.SCORE_CALIBRATION_B) for chunk in chunks]
+        results = [score >= Config.THRESHOLD for score in scores]
+        if Config.STRATEGY == 'thres':
+            return results
 
-            chunk_key = frozenset(chunk_copy.items())
+        uncertain_indexes = [i for i, score in enumerate(scores) if abs(score - Config.THRESHOLD) < Config.THRESHOLD_UNCERTAINTY_BAND]
+        logger.info(f"阈值判断完成，{len(uncertain_indexes)}/{len(chunks)} 个切片需要LLM判断")
+        if uncertain_indexes:
+            judgements = await self.chunks_judge_relevant(llm_service, query, [chunks[i] for i in uncertain_indexes], history)
+            for i, judgement in zip(uncertain_indexes, judgements):
+                results[i] = judgement
+        return results
 
-            if chunk_key not in retrieved_chunks_map:
-                retrieved_chunks_map[chunk_key] = {
-                    'score': score_value,
-                    **chunk_copy
-                }
-            else:
-                existing_score = retrieved_chunks_map[chunk_key]['score']
-                if score_value > existing_score:
-                    retrieved_chunks_map[chunk_key] = {
-                        'score': score_value,
-                        **chunk_copy
-                    }
-
-        deduplicated_chunks = []
-        for chunk_key, chunk_data in retrieved_chunks_map.items():
-            restored_chunk = {
-                'score': chunk_data['score'],
-                **dict(chunk_key)
-            }
-            deduplicated_chunks.append(restored_chunk)
+    async def chunks_judge_relevant(self, llm_service: LLM_Service, query, chunks, history=[]) -> List[Optional[bool]]:
+        '''
+        判断多个切片是否与用户的问题相关。开启批量判断时所有切片编号后放入一次请求，输出不合法时回退为逐个判断；
+        批量请求失败时不再逐个请求，全部结果为None
+        '''
+        if not chunks:
+            return []
+        if Config.JUDGE_BATCH_ENABLED and len(chunks) > 1:
+            chunk_texts = "\n\n".join(
+                f"[{i + 1}] {chunk['text'][:Config.JUDGE_CHUNK_MAX_LENGTH]}" for i, chunk in enumerate(chunks)
+            )
+            prompt = prompts.BATCH_RELEVANT_PROMPT_TEMPLATE.format(chunk_texts=chunk_texts, query=query, chunk_count=len(chunks))
+            try:
+                response = await llm_service.async_chat_completion(
+                    [*history, {"role": "user", "content": prompt}],
+                    temperature=0, cache=Config.LLM_CACHE_JUDGE_ENABLED,
+                    cache_tags=list(dict.fromkeys(chunk['doc_id'] for chunk in chunks)),
+                    raise_on_error=True
+                )
+            except LLMServiceError as e:
+                logger.warning(f"批量相关性判断失败: {e}")
+                return [None] * len(chunks)
+            judgements = self.parse_batch_judgements(response, len(chunks))
+            if judgements is not None:
+                return judgements
+            logger.warning(f"批量相关性判断结果解析失败，回退为逐个判断: {response}")
+
+        tasks = [self.chunk_judge_relevant(llm_service, query, chunk, history) for chunk in chunks]
+        return list(await asyncio.gather(*tasks))
 
-        return deduplicated_chunks
+    def parse_batch_judgements(self, response: str, chunk_count: int) -> Optional[List[bool]]:
+        '''
+        解析批量判断结果，要求为长度等于chunk_count的JSON数组，元素为“是”/“否”（兼容true/false、1/0），否则返回None
+        '''
+        match = re.search(r'\[[\s\S]*\]', response or "")
+        if not match:
+            return None
+        try:
+            judgements = json.loads(match.group(0))
+        except ValueError:
+            return None
+        if not isinstance(judgements, list) or len(judgements) != chunk_count:
+            return None
+
+        results = []
+        for judgement in judgements:
+            if judgement in ("是", True, 1):
+                results.append(True)
+            elif judgement in ("否", False, 0):
+                results.append(False)
+            else:
+                return None
+        return results
     
-    async def chunk_judge_relevant(self, llm_service: LLM_Service, query, chunk, history=[]):
+    async def chunk_judge_relevant(self, llm_service: LLM_Service, query, chunk, history=[]) -> Optional[bool]:
         '''
-        判断切片的文本是否与用户的问题相关
+        判断切片的文本是否与用户的问题相关，LLM调用失败时返回None
         '''
         prompt = prompts.RELEVANT_PROMPT_TEMPLATE.format(chunk_text=chunk['text'][:500], query=query)
-        response = await llm_service.async_chat_completion(
-            [*history, {"role": "user", "content": prompt}],
-            temperature=0, extra_body={"type": ["否", "是"]}
-        )
+        try:
+            response = await llm_service.async_chat_completion(
+                [*history, {"role": "user", "content": prompt}],
+                temperature=0, extra_body={"type": ["否", "是"]},
+                cache=Config.LLM_CACHE_JUDGE_ENABLED, cache_tags=[chunk['doc_id']],
+                raise_on_error=True
+            )
+        except LLMServiceError as e:
+            logger.warning(f"相关性判断失败: {e}")
+            return None
         return response.strip() == "是"
     
     async def chat_judge_relevant(self, llm_service: LLM_Service, query, history=[]):
@@ -163,16 +370,20 @@ class RAGService:
         )
         return response.strip() == "是"
     
-    async def decorate_answer(self, request_id, llm_service: LLM_Service, chunks, messages):
-        '''
-        将从知识库中检索到的chunks放入最终回答指令, 生成答案。
-        '''
+    def build_answer_instruction(self, chunks) -> str:
         kb_text = "\n\n".join(chunk["text"] for chunk in chunks)
-        instruction = prompts.ANSWER_PROMPT_TEMPLATE.format(
+        return prompts.ANSWER_PROMPT_TEMPLATE.format(
             current_date=time.strftime("%Y年%m月%d日", time.localtime()),
             kb_text=kb_text
         )
+
+    async def decorate_answer(self, request_id, llm_service: LLM_Service, chunks, messages, raise_on_error=False):
+        '''
+        将从知识库中检索到的chunks放入最终回答指令, 生成答案。
+        '''
+        instruction = self.build_answer_instruction(chunks)
         response = await llm_service.async_chat_completion(
             [{"role": "system", "content": instruction}, *messages],
+            raise_on_error=raise_on_error
         )
-        return instruction, response
\ No newline at end of file
+        return instruction, response
@@ -4,9 +4,10 @@ from service.config import Config
 
 class RedisService:
 
-    def __init__(self, host, port, password, document_key):
+    def __init__(self, host, port, password, document_key, corpus_version_key):
         self.client = redis.Redis(host=host, port=port, password=password, decode_responses=True)
         self.document_key = document_key
+        self.corpus_version_key = corpus_version_key
         logger.info("Successfully connected to Redis")
 
     def get_disabled_document(self):
@@ -23,6 +24,17 @@ class RedisService:
                 self.client.srem(self.document_key, document_uuid)
             else:
                 self.client.sadd(self.document_key, document_uuid)
+        self.bump_corpus_version()
         logger.info(f"已更新文件 {document_uuid} 的状态")
 
-redis_service = RedisService(host=Config.REDIS_HOST, port=Config.REDIS_PORT, password=Config.REDIS_PASSWORD, document_key=Config.REDIS_KEY)
\ No newline at end of file
+    def get_corpus_version(self) -> int:
+        # 知识库版本号，文档新增、删除、禁用状态变化时递增，用于缓存失效
+        version = self.client.get(self.corpus_version_key)
+        return int(version) if version else 0
+
+    def bump_corpus_version(self) -> int:
+        version = self.client.incr(self.corpus_version_key)
+        logger.info(f"知识库版本号更新为 {version}")
+        return version
+
+redis_service = RedisService(host=Config.REDIS_HOST, port=Config.REDIS_PORT, password=Config.REDIS_PASSWORD, document_key=Config.REDIS_KEY, corpus_version_key=Config.REDIS_CORPUS_VERSION_KEY)
\ No newline at end of file
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+from typing import List, Optional
+
+from utils.cache_util import BoundedLRUCache, normalize_query
+
+
+class RerankScoreCache:
+    '''
+    重排序分数缓存，键为(归一化查询, chunk_id, 知识库版本号)，只有未命中的(查询, 切片)对才需要经过交叉编码器。
+    同时统计单个切片对的平均模型耗时，用于估算缓存节省的模型时间。
+    '''
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.local = BoundedLRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self.model_pairs = 0
+        self.model_seconds = 0.0
+        self.saved_pairs = 0
+
+    def make_key(self, query: str, chunk_id: str, corpus_version: int) -> tuple:
+        return (normalize_query(query), chunk_id, corpus_version)
+
+    def get_many(self, query: str, chunk_ids: List[str], corpus_version: int) -> List[Optional[float]]:
+        scores = [self.local.get(self.make_key(query, chunk_id, corpus_version)) for chunk_id in chunk_ids]
+        with self._lock:
+            self.saved_pairs += sum(score is not None for score in scores)
+        return scores
+
+    def put_many(self, query: str, chunk_ids: List[str], scores: List[float], corpus_version: int):
+        for chunk_id, score in zip(chunk_ids, scores):
+            key = self.make_key(query, chunk_id, corpus_version)
+            self.local.put(key, score, size=sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(key[1]) + sys.getsizeof(score))
+
+    def record_model_time(self, pairs: int, seconds: float):
+        with self._lock:
+            self.model_pairs += pairs
+            self.model_seconds += seconds
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        with self._lock:
+            seconds_per_pair = self.model_seconds / self.model_pairs if self.model_pairs else 0.0
+            stats.update({
+                "model_pairs": self.model_pairs,
+                "model_seconds": self.model_seconds,
+                "saved_model_seconds": self.saved_pairs * seconds_per_pair,
+            })
+        return stats
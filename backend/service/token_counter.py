@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+from typing import List
+
+from service.config import Config
+from utils.cache_util import BoundedLRUCache
+
+
+class TokenCounter:
+    '''
+    按嵌入模型的快速分词器统计文本的token数，用作切分器的长度函数。分词器在首次统计时加载；
+    结果按文本缓存，批量统计时只对未命中的文本调用一次分词器
+    '''
+    def __init__(self, tokenizer_path: str, max_entries: int, max_bytes: int):
+        self.tokenizer_path = tokenizer_path
+        self.local = BoundedLRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def get_tokenizer(self):
+        # 调用方需持有self._lock，快速分词器不支持多线程并发调用
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path, use_fast=True)
+        return self._tokenizer
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        counts = [self.local.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, count in zip(texts, counts) if count is None))
+        if not missing:
+            return counts
+        with self._lock:
+            input_ids = self.get_tokenizer()(
+                missing, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False, verbose=False
+            )["input_ids"]
+        fresh = {}
+        for text, ids in zip(missing, input_ids):
+            fresh[text] = len(ids)
+            self.local.put(text, len(ids), size=sys.getsizeof(text) + sys.getsizeof(len(ids)))
+        return [fresh[text] if count is None else count for text, count in zip(texts, counts)]
+
+    def __call__(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def stats(self) -> dict:
+        return self.local.stats()
+
+
+token_counter = TokenCounter(
+    tokenizer_path=Config.EMBEDDING_MODEL,
+    max_entries=Config.TOKEN_COUNT_CACHE_MAX_ENTRIES,
+    max_bytes=Config.TOKEN_COUNT_CACHE_MAX_MB * 1024 * 1024
+)
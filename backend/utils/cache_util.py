@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_query(text: str) -> str:
+    """查询文本归一化：全角半角统一、大小写折叠、去除标点并合并空白，用作缓存键。"""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ''.join(' ' if unicodedata.category(ch).startswith('P') else ch for ch in text)
+    return _WHITESPACE_PATTERN.sub(' ', text).strip()
+
+
+class BoundedLRUCache:
+    """
+    线程安全的LRU缓存，同时受条目数与内存占用约束，可选过期时间，并统计命中/未命中次数。
+    """
+    def __init__(self, max_entries: int, max_bytes: int = None, ttl: float = None, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl is not None and item[2] < time.monotonic():
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size: int = None):
+        size = self.sizeof(value) if size is None else size
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expire_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expire_at)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                oldest_key = next(iter(self._data))
+                self._remove(oldest_key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def discard_if(self, predicate) -> int:
+        """删除所有满足predicate(key, value)的条目，返回删除数量。"""
+        with self._lock:
+            keys = [key for key, (value, _, _) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        # 调用方需持有self._lock
+        value, size, _ = self._data.pop(key)
+        self._bytes -= size
+        return value
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def _logit(scores, eps=1e-6):
+    scores = np.clip(np.asarray(scores, dtype=np.float64), eps, 1 - eps)
+    return np.log(scores / (1 - scores))
+
+
+def calibrate_score(score: float, a: float = 1.0, b: float = 0.0) -> float:
+    """对重排序模型的sigmoid分数做Platt缩放：sigmoid(a * logit(score) + b)。a=1、b=0时为恒等变换。"""
+    z = a * float(_logit([score])[0]) + b
+    return 1 / (1 + math.exp(-z))
+
+
+def fit_platt_scaling(scores: List[float], labels: List[int], iterations: int = 100) -> Tuple[float, float]:
+    """用牛顿法在logit(score)上拟合逻辑回归，返回Platt缩放参数(a, b)。"""
+    x = _logit(scores)
+    y = np.asarray(labels, dtype=np.float64)
+    # Platt提出的目标值平滑，避免在可分样本上参数发散
+    positives, negatives = y.sum(), len(y) - y.sum()
+    y = np.where(y > 0, (positives + 1) / (positives + 2), 1 / (negatives + 2))
+
+    a, b = 1.0, 0.0
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-(a * x + b)))
+        w = p * (1 - p) + 1e-12
+        gradient = np.array([np.sum((p - y) * x), np.sum(p - y)])
+        hessian = np.array([
+            [np.sum(w * x * x), np.sum(w * x)],
+            [np.sum(w * x), np.sum(w)]
+        ]) + np.eye(2) * 1e-9
+        step = np.linalg.solve(hessian, gradient)
+        a, b = a - step[0], b - step[1]
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    return float(a), float(b)
+
+
+def fit_threshold(scores: List[float], labels: List[int], target_precision: Optional[float] = None) -> dict:
+    """
+    在已标注样本上选择相关性阈值。
+    默认选择F1最高的阈值；给定target_precision时，选择满足精确率要求且召回率最高的阈值。
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    total_positives = int(labels.sum())
+
+    best = None
+    for threshold in np.unique(scores):
+        predicted = scores >= threshold
+        true_positives = int(np.sum(predicted & (labels == 1)))
+        precision = true_positives / int(predicted.sum()) if predicted.any() else 0.0
+        recall = true_positives / total_positives if total_positives else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        candidate = {"threshold": float(threshold), "precision": precision, "recall": recall, "f1": f1}
+        if target_precision is not None:
+            if precision < target_precision:
+                continue
+            if best is None or recall > best["recall"]:
+                best = candidate
+        elif best is None or f1 > best["f1"]:
+            best = candidate
+    return best
@@ -5,7 +5,9 @@ import os
 import hashlib
 import time
 import random
+import queue
 import logging
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import torch
@@ -26,12 +28,53 @@ def batch_generator(iterable, batch_size):
         yield batch
 
 
-def calculate_file_hash(file_path):
-    """计算文件内容的哈希值（SHA256）。"""
+def prefetch_generator(iterable, max_prefetch):
+    """在后台线程中迭代iterable并预取最多max_prefetch个元素，使生产与消费并行；生产端的异常在消费端重新抛出。"""
+    items = queue.Queue(maxsize=max_prefetch)
+    stop_event = threading.Event()
+    end_marker = object()
+
+    def put(item):
+        # 消费端提前退出后不再阻塞生产线程
+        while not stop_event.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((end_marker, e))
+            return
+        put((end_marker, None))
+
+    threading.Thread(target=produce, name="prefetch", daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end_marker:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop_event.set()
+
+
+def calculate_file_hash(file_path, chunk_size=1024 * 1024):
+    """计算文件内容的哈希值（SHA256），按块读取，内存占用与文件大小无关。"""
     try:
+        hasher = hashlib.sha256()
         with open(file_path, 'rb') as f:
-            file_content = f.read()
-        file_hash = hashlib.sha256(file_content).hexdigest()
+            while chunk := f.read(chunk_size):
+                hasher.update(chunk)
+        file_hash = hasher.hexdigest()
         filename = os.path.basename(file_path)
         doc_name = os.path.basename(os.path.dirname(file_path))
         return filename, doc_name, file_hash
@@ -40,45 +83,60 @@ def calculate_file_hash(file_path):
         return None
 
 
-def get_current_files(data_dir):
-    """获取当前目录中所有的文件及其哈希值，用于与已记录的哈希进行比较"""
+def save_stream_with_hash(src, file_path, chunk_size=1024 * 1024):
+    """将文件流按块写入file_path，同时增量计算SHA256，返回(哈希值, 文件大小)。"""
+    hasher = hashlib.sha256()
+    file_size = 0
+    with open(file_path, 'wb') as f:
+        while chunk := src.read(chunk_size):
+            hasher.update(chunk)
+            f.write(chunk)
+            file_size += len(chunk)
+    return hasher.hexdigest(), file_size
+
+
+def get_current_files(data_dir, extensions=None, max_workers=8):
+    """并行计算目录中所有文件的哈希值，返回{绝对路径: (文件哈希, 文件大小)}，用于与已记录的哈希进行比较"""
+    data_dir = os.path.abspath(data_dir)
     current_files = {}
-    futures = []
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         for root, _, files in os.walk(data_dir):
-            if os.path.commonpath([data_dir, root]) != data_dir:
-                continue
-            doc_name = os.path.basename(os.path.relpath(root, data_dir))
-            md_files = [f for f in files if f.endswith('.md')]
-            for filename in md_files:
-                file_path = os.path.abspath(os.path.join(root, filename))
-                futures.append(executor.submit(calculate_file_hash, file_path))
+            for filename in files:
+                # 跳过隐藏文件及Office临时文件
+                if filename.startswith(('.', '~$')):
+                    continue
+                if extensions is not None and ('.' not in filename or filename.rsplit('.', 1)[1].lower() not in extensions):
+                    continue
+                file_path = os.path.join(root, filename)
+                futures[executor.submit(calculate_file_hash, file_path)] = file_path
 
         for future in tqdm(as_completed(futures), total=len(futures), desc="计算文件哈希"):
             result = future.result()
             if result:
-                filename, doc_name, file_hash = result
-                current_files[filename] = (doc_name, file_hash)
+                file_path = futures[future]
+                _, _, file_hash = result
+                current_files[file_path] = (file_hash, os.path.getsize(file_path))
 
     logging.info(f"当前目录中找到 {len(current_files)} 个文件。")
     return current_files
 
 
-def delete_removed_files(col, redis_manager, existing_file_hashes, current_files):
-    """删除已删除文件对应的 Milvus 记录和 Redis 哈希值。"""
-    to_delete = [chunk_file for chunk_file in existing_file_hashes if chunk_file not in current_files]
+def delete_removed_files(document_service, synced_documents, current_files):
+    """删除目录中已不存在的文件对应的文档记录及向量，synced_documents为{源文件路径: 文档}。"""
+    to_delete = [source_path for source_path in synced_documents if source_path not in current_files]
 
     if to_delete:
         logging.info(f"将删除 {len(to_delete)} 个文件的记录")
-        expr = f'chunk_file in ["' + '","'.join(to_delete) + '"]'
-        try:
-            col.delete(expr=expr)
-            logging.info(f"已删除 {len(to_delete)} 个文件的记录")
-            redis_manager.delete_file_hashes(to_delete)
-            return len(to_delete)
-        except Exception as e:
-            logging.error(f"删除文件记录时出错：{e}")
-            return 0
+        deleted = 0
+        for source_path in to_delete:
+            try:
+                if document_service.delete_document(str(synced_documents[source_path].id)):
+                    deleted += 1
+            except Exception as e:
+                logging.error(f"删除文件记录时出错：{source_path}, 错误：{e}")
+        logging.info(f"已删除 {deleted} 个文件的记录")
+        return deleted
     else:
         logging.info("没有找到需要删除的文件记录")
         return 0
@@ -6,6 +6,86 @@ import shutil
 import logging
 
 
+METADATA_PATTERN = re.compile(r'(?s)^(---[\s\S]+?---)')
+HEADER_PATTERN = re.compile(r'^(#{2,4})\s+(.*)')
+HEADER_LINE_PATTERN = re.compile(r'^#{2,4}\s')
+TOC_PATTERN = re.compile(r'^\#{2,4}\s+\d+(\.\d+)*\.?\s')
+FENCE_PATTERN = re.compile(r'^\s*(```|~~~)')
+
+def has_content(lines):
+    for line in lines:
+        if not HEADER_LINE_PATTERN.match(line) and line.strip() != '':
+            return True
+    return False
+
+
+def iter_header_sections(lines):
+    """按二至四级标题逐段产出(标题栈, 正文行列表)，缺失的上级标题以空字符串占位，代码块中的#行不视为标题，没有正文的段落跳过。"""
+    header_stack = []
+    body_lines = []
+    in_fence = False
+    for line in lines:
+        if FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+        header_match = None if in_fence else HEADER_PATTERN.match(line)
+        if header_match is None:
+            body_lines.append(line)
+            continue
+        if has_content(body_lines):
+            yield header_stack, body_lines
+        header_level = len(header_match.group(1))
+        header_stack = (header_stack + [''] * header_level)[:header_level - 2] + [line.strip()]
+        body_lines = []
+    if has_content(body_lines):
+        yield header_stack, body_lines
+
+
+class MarkdownChunker:
+    """
+    内存中的标题感知Markdown切分：逐行处理，跳过文件头元数据，按二至四级标题划分章节，不读写任何中间文件。
+    超过chunk_size的章节继续细分，每个切片以所属标题路径开头。标题路径计入切片长度：章节正文按chunk_size
+    减去标题路径长度（length_function计量）后的预算切分，预算至少保留chunk_size的一半；
+    splitter_factory(budget)返回按该预算切分的切分器。
+    """
+    def __init__(self, splitter_factory, chunk_size, length_function=len):
+        self.splitter_factory = splitter_factory
+        self.chunk_size = chunk_size
+        self.length_function = length_function
+        self._splitters = {}
+
+    def iter_chunks(self, lines):
+        for header_stack, body_lines in iter_header_sections(self.strip_metadata(lines)):
+            prefix = '\n'.join(header for header in header_stack if header)
+            budget = self.chunk_size - self.length_function(f'{prefix}\n') if prefix else self.chunk_size
+            for piece in self.get_splitter(max(budget, self.chunk_size // 2)).split_text('\n'.join(body_lines).strip()):
+                yield f'{prefix}\n{piece}' if prefix else piece
+
+    def get_splitter(self, budget):
+        # 相同长度的标题路径复用同一个切分器
+        if budget not in self._splitters:
+            self._splitters[budget] = self.splitter_factory(budget)
+        return self._splitters[budget]
+
+    def strip_metadata(self, lines):
+        # 文件开头以---包围的元数据不参与切分
+        lines = iter(lines)
+        first_line = next(lines, None)
+        if first_line is None:
+            return
+        if first_line.strip() != '---':
+            yield first_line
+            yield from lines
+            return
+        metadata_lines = [first_line]
+        for line in lines:
+            metadata_lines.append(line)
+            if line.strip() == '---':
+                yield from lines
+                return
+        # 元数据未闭合时按正文处理
+        yield from metadata_lines
+
+
 class MarkdownSplitter:
     def __init__(self, input_file, output_dir, logger):
         self.input_file = os.path.abspath(input_file)
@@ -19,8 +99,7 @@ class MarkdownSplitter:
             return file.read()
 
     def extract_metadata(self, content):
-        metadata_pattern = r'(?s)^(---[\s\S]+?---)'
-        match = re.match(metadata_pattern, content)
+        match = METADATA_PATTERN.match(content)
         if match:
             metadata = match.group(1)
             content = content[len(metadata):].lstrip()
@@ -28,61 +107,22 @@ class MarkdownSplitter:
         return None, content
 
     def split_by_headers(self, content):
-        lines = content.splitlines()
-        segments = []
-        current_segment_lines = []
-        header_stack = []
-
-        for i, line in enumerate(lines):
-            header_match = re.match(r'^(#{2,4})\s+(.*)', line)
-            if header_match:
-                header_level = len(header_match.group(1))
-                if header_level == 2:
-                    if self.has_content(current_segment_lines):
-                        segments.append('\n'.join(current_segment_lines).strip())
-                    header_stack = [line.strip()]
-                    current_segment_lines = header_stack.copy()
-                elif header_level == 3:
-                    if self.has_content(current_segment_lines):
-                        segments.append('\n'.join(current_segment_lines).strip())
-                    if len(header_stack) < 1:
-                        header_stack = ['']
-                    header_stack = [header_stack[0], line.strip()]
-                    current_segment_lines = header_stack.copy()
-                elif header_level == 4:
-                    if self.has_content(current_segment_lines):
-                        segments.append('\n'.join(current_segment_lines).strip())
-                    if len(header_stack) < 2:
-                        if len(header_stack) == 0:
-                            header_stack = ['']
-                        header_stack = header_stack + ['']
-                    header_stack = header_stack[:2] + [line.strip()]
-                    current_segment_lines = header_stack.copy()
-                else:
-                    current_segment_lines.append(line)
-            else:
-                current_segment_lines.append(line)
-
-        if self.has_content(current_segment_lines):
-            segments.append('\n'.join(current_segment_lines).strip())
-
+        segments = ['\n'.join(header_stack + body_lines).strip() for header_stack, body_lines in iter_header_sections(content.splitlines())]
         return [seg for seg in segments if seg.strip()]
 
     def has_content(self, lines):
-        for line in lines:
-            if not re.match(r'^#{2,4}\s', line) and line.strip() != '':
-                return True
-        return False
+        return has_content(lines)
 
-    def extract_toc_from_content(self):
-        markdown_content = self.read_markdown()
+    def extract_toc_from_content(self, markdown_content=None):
+        if markdown_content is None:
+            markdown_content = self.read_markdown()
         toc = []
         for line in markdown_content.splitlines():
-            if re.match(r'^\#{2,4}\s+\d+(\.\d+)*\.?\s', line):
+            if TOC_PATTERN.match(line):
                 toc.append(line.strip())
         return '\n'.join(toc)
 
-    def save_segments(self, segments, metadata=None):
+    def save_segments(self, segments, metadata=None, toc=None):
         base_dir = os.path.join(self.output_dir, os.path.splitext(os.path.basename(self.input_file))[0])
         base_dir = os.path.abspath(base_dir)
         os.makedirs(base_dir, exist_ok=True)
@@ -103,7 +143,8 @@ class MarkdownSplitter:
                 seg_file.write(segment + '\n')
             chunk_file_paths.append(segment_file_path)
 
-        toc = self.extract_toc_from_content()
+        if toc is None:
+            toc = self.extract_toc_from_content()
         toc_file_path = os.path.join(base_dir, f'{base_filename}_toc.md')
         toc_file_path = os.path.abspath(toc_file_path)
         with open(toc_file_path, 'w', encoding='utf-8') as toc_file:
@@ -113,9 +154,10 @@ class MarkdownSplitter:
 
     def process(self):
         markdown_content = self.read_markdown()
+        toc = self.extract_toc_from_content(markdown_content)
         metadata, markdown_content = self.extract_metadata(markdown_content)
         chunks = self.split_by_headers(markdown_content)
-        return self.save_segments(chunks, metadata)
+        return self.save_segments(chunks, metadata, toc)
 
 
 def process_directory(input_dir, output_dir, logger):
@@ -58,6 +58,18 @@ RELEVANT_PROMPT_TEMPLATE = """你是一个智能助手，负责判断给定的
 请回答：这段文档对回答问题有帮助吗？请仅回答“是”或“否”。"""
 
 
+# 一次请求批量判断多个文档片段与用户问题相关性的Prompt
+BATCH_RELEVANT_PROMPT_TEMPLATE = """你是一个智能助手，负责逐个判断下列编号的文档片段是否对回答用户的问题有帮助，要求不要太严格，文档片段符合问题的片段上下文即可。
+文档片段：
+{chunk_texts}
+
+问题：
+{query}
+
+请按片段编号顺序，对每个片段回答“是”或“否”，以 JSON 数组形式返回，数组长度必须为 {chunk_count}，例如：["是", "否", "是"]。
+请不要包含任何解释或注释，也不要使用 Markdown 代码块，请直接返回 JSON。"""
+
+
 # 用于生成答案的Prompt
 ANSWER_PROMPT_TEMPLATE = """你是一个智能助手，你需要从知识库中选择相关信息来回答用户的问题。在回答时，请特别注意以下几点：
 
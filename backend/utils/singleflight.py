@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """
+    请求合并：相同键的并发调用共享同一次进行中的计算，全部调用方得到同一个结果。
+    计算在独立任务中执行，单个调用方取消不会影响其他等待者。
+    """
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done_task: self._on_done(key, done_task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+            "coalesced_rate": self.coalesced / self.calls if self.calls else 0.0,
+        }
+
+    def _on_done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有调用方都已取消时，避免出现未读取异常的告警
+        if not task.cancelled():
+            task.exception()
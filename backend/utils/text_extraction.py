@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+批量入库解析进程池调用的文本解析函数。解析子进程以spawn方式启动并导入本模块，
+因此这里只依赖解析所需的库，不导入torch等重量级模块。
+"""
+
+import docx2txt
+from pypdf import PdfReader
+
+
+def count_pdf_pages(file_path):
+    """返回PDF页数，用于将大PDF拆分为多个页范围解析任务。"""
+    return len(PdfReader(file_path).pages)
+
+
+def extract_pdf_pages(file_path, start, end):
+    """解析PDF第[start, end)页的文本，返回逐页文本列表，供进程池调用。"""
+    reader = PdfReader(file_path)
+    pages = []
+    for index in range(start, min(end, len(reader.pages))):
+        extracted = reader.pages[index].extract_text()
+        if extracted:
+            pages.append(extracted + "\n")
+    return pages
+
+
+def extract_file_segments(file_path):
+    """解析非PDF文件的文本，返回文本段列表，供进程池调用。"""
+    file_extension = file_path.split('.')[-1].lower()
+    if file_extension in ('docx', 'doc'):
+        text = docx2txt.process(file_path)
+    else:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    return [text] if text else []
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+
+# 中文文本通常没有空格，在换行之后按句末及句中标点切分，避免退化为逐字切分
+TOKEN_SEPARATORS = ["\n\n", "\n", "。", "！", "？", "；", "，", ". ", "! ", "? ", " ", ""]
+
+
+def split_by_bytes(text, max_bytes):
+    """将UTF-8编码超过max_bytes字节的文本按字符边界拆分为多段，每段编码后不超过max_bytes。"""
+    if len(text) * 4 <= max_bytes or len(text.encode('utf-8')) <= max_bytes:
+        return [text]
+    pieces = []
+    start = size = 0
+    for index, ch in enumerate(text):
+        ch_size = len(ch.encode('utf-8', 'surrogatepass'))
+        if size + ch_size > max_bytes:
+            pieces.append(text[start:index])
+            start, size = index, 0
+        size += ch_size
+    pieces.append(text[start:])
+    return pieces
+
+
+class TokenLengthTextSplitter(RecursiveCharacterTextSplitter):
+    """
+    以token数计量长度的递归切分器：token_counter为带缓存的分词计数器，切分与合并过程中重复出现的片段直接命中缓存。
+    切片在不超过chunk_size的前提下尽量合并。
+    """
+    def __init__(self, token_counter, chunk_size, chunk_overlap, **kwargs):
+        kwargs.setdefault("separators", TOKEN_SEPARATORS)
+        kwargs.setdefault("keep_separator", "end")
+        self.add_start_index = kwargs.get("add_start_index", False)
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=token_counter, **kwargs)
+
+    def create_documents(self, texts, metadatas=None):
+        # 父类用字符长度减去重叠长度回推下一个切片的查找起点，重叠以token计时会越过切片的真实起点，这里从上一切片起点之后查找
+        _metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for i, text in enumerate(texts):
+            index = -1
+            for chunk in self.split_text(text):
+                metadata = copy.deepcopy(_metadatas[i])
+                if self.add_start_index:
+                    index = text.find(chunk, index + 1)
+                    metadata["start_index"] = index
+                documents.append(Document(page_content=chunk, metadata=metadata))
+        return documents
@@ -25,7 +25,9 @@ CREATE TABLE if not exists documents (
     file_size INTEGER NOT NULL,
     file_type VARCHAR(255) NOT NULL,
     file_hash VARCHAR(255) NOT NULL,
-    upload_time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    upload_time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    source_path VARCHAR(1024),
+    version INTEGER NOT NULL DEFAULT 1
 );
 
 -- 创建索引以提高查询性能
@@ -33,6 +35,7 @@ CREATE INDEX idx_conversation_messages_conversation_id ON conversation_messages(
 CREATE INDEX idx_conversation_messages_sequence ON conversation_messages(sequence);
 CREATE INDEX idx_conversations_created_at ON conversations(created_at);
 CREATE INDEX idx_conversations_updated_at ON conversations(updated_at);
+CREATE INDEX idx_documents_source_path ON documents(source_path);
 
 -- 创建更新updated_at的触发器函数
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -2,8 +2,8 @@ import { createStore } from 'vuex'
 
 export default createStore({
     state: {
-        chunkSize: 100,
-        overlapSize: 20,
+        chunkSize: 512,
+        overlapSize: 64,
         embeddingModel: 'BGE M3',
         topK: 3,
         embeddingModels: [